@@ -0,0 +1,297 @@
+import os
+import socket
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from dataclasses import asdict
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Iterator
+
+from flask import json
+from backends.factory import get_job_queue, get_result_cache
+from models.dto_models import ChartDTO, DataPoint, chartEntry
+
+try:
+    import fcntl
+except ImportError: # Windows dev machines, R admission then only counts this process
+    fcntl = None
+
+MAX_CONCURRENT_RSCRIPTS = int(os.environ.get("MAX_CONCURRENT_RSCRIPTS", 2))
+ADMISSION_TIMEOUT_SECONDS = float(os.environ.get("ADMISSION_TIMEOUT_SECONDS", 30))
+RSCRIPT_TIMEOUT_SECONDS = float(os.environ.get("RSCRIPT_TIMEOUT_SECONDS", 300))
+MAX_QUEUED_CHARTS = int(os.environ.get("MAX_QUEUED_CHARTS", 32)) # queued and running jobs of all instances
+CHART_WORKERS = int(os.environ.get("CHART_WORKERS", MAX_CONCURRENT_RSCRIPTS)) # per instance
+CHART_CACHE_TTL_SECONDS = float(os.environ.get("CHART_CACHE_TTL_SECONDS", 3600))
+LOCK_POLL_SECONDS = 0.05
+WORKER_POLL_SECONDS = 0.2
+PURGE_INTERVAL_SECONDS = 600
+LOCKS_DIR = "./instance/locks"
+
+
+#No R slot became free within ADMISSION_TIMEOUT_SECONDS
+class ChartBusyError(RuntimeError):
+    pass
+
+#The R script (or the computation we were waiting on) took too long
+class ChartTimeoutError(RuntimeError):
+    pass
+
+#The worker computing the chart failed
+class ChartJobError(RuntimeError):
+    pass
+
+#The R script exited with an error, the job fails so the result isn't cached
+class RScriptError(ChartJobError):
+    pass
+
+# Error kinds stored on failed jobs, raised again on the instance waiting for the result.
+# Subclasses come before their base class, the first matching kind is stored.
+JOB_ERRORS: dict[str, type[RuntimeError]] = {
+    "busy": ChartBusyError,
+    "timeout": ChartTimeoutError,
+    "rscript": RScriptError,
+    "error": ChartJobError,
+}
+
+
+_in_flight: dict[str, Future] = {}
+_in_flight_lock = threading.Lock()
+_local_slots = threading.BoundedSemaphore(MAX_CONCURRENT_RSCRIPTS)
+_named_locks: dict[str, threading.Lock] = {}
+_named_locks_lock = threading.Lock()
+
+
+"""Runs a chart job once for all concurrent callers with the same key.
+
+Threads of this process wait on the first caller's future. That caller
+serves the shared result cache, or queues the job on the shared job queue
+and waits until a worker of any instance has cached the result.
+
+Keyword arguments:
+key -- identifies the chart, must include everything the result depends on
+payload -- JSON serializable job description passed to the workers' handler
+Return:
+the chart computed by whichever worker picked the job up
+"""
+def run_once(key: str, payload: dict) -> ChartDTO | None:
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        leader = future is None
+        if leader:
+            future = Future()
+            _in_flight[key] = future
+    if not leader:
+        return future.result() # type: ignore
+
+    try:
+        result = _run_shared(key, payload)
+        future.set_result(result) # type: ignore
+        return result
+    except BaseException as e:
+        future.set_exception(e) # type: ignore
+        raise
+    finally:
+        with _in_flight_lock:
+            del _in_flight[key]
+
+
+def _run_shared(key: str, payload: dict) -> ChartDTO | None:
+    queue, cache = get_job_queue(), get_result_cache()
+    cached = cache.get(key)
+    if cached is not None:
+        return _chart_from_json(cached)
+    job = queue.get(key)
+    if (job is None or job.status in ("done", "failed")) and queue.pending_count() >= MAX_QUEUED_CHARTS:
+        raise ChartBusyError("Too many charts are being computed, try again later")
+    queue.enqueue(key, payload)
+
+    deadline = time.monotonic() + ADMISSION_TIMEOUT_SECONDS + RSCRIPT_TIMEOUT_SECONDS
+    while True:
+        # Workers cache the result before marking the job done
+        cached = cache.get(key)
+        if cached is not None:
+            return _chart_from_json(cached)
+        job = queue.get(key)
+        if job is not None and job.status == "failed":
+            raise JOB_ERRORS.get(job.error_kind, ChartJobError)(job.error) # type: ignore
+        if time.monotonic() > deadline:
+            raise ChartTimeoutError("Timed out waiting for the chart to be computed")
+        time.sleep(LOCK_POLL_SECONDS)
+
+
+"""Streams the series of a chart, sharing the run like run_once.
+
+A cached result is replayed. If the key is already queued or running on any
+instance its result is awaited. Otherwise stream runs here, its series are
+forwarded as they arrive and the complete chart is cached for everyone else.
+
+Keyword arguments:
+key -- identifies the chart, as for run_once
+payload -- job payload, used if the chart has to be awaited
+chart -- chart the streamed series belong to, values are filled in for the cache
+stream -- function yielding the series of the chart
+Return:
+iterator over the series of the chart
+"""
+def stream_once(key: str, payload: dict, chart: ChartDTO, stream: Callable[[], Iterator[chartEntry]]) -> Iterator[chartEntry]:
+    queue, cache = get_job_queue(), get_result_cache()
+    cached = cache.get(key)
+    job = None
+    if cached is None:
+        job = queue.start(key, payload, f"{socket.gethostname()}-{os.getpid()}-stream")
+    if job is None:
+        result = _chart_from_json(cached) if cached is not None else run_once(key, payload)
+        if result is not None:
+            yield from result.values
+        return
+
+    values: list[chartEntry] = []
+    entries = stream()
+    try:
+        for entry in entries:
+            values.append(entry)
+            yield entry
+        chart.values = values
+        cache.set(key, _chart_to_json(chart), CHART_CACHE_TTL_SECONDS)
+        queue.complete(job.id)
+    except GeneratorExit:
+        # The client went away, others may be waiting on the key: a worker computes it instead
+        entries.close() # type: ignore
+        queue.release(job.id)
+        raise
+    except Exception as e:
+        kind = next((k for k, error in JOB_ERRORS.items() if isinstance(e, error)), "error")
+        queue.fail(job.id, kind, str(e) or type(e).__name__)
+        raise
+
+
+"""Starts the chart workers of this instance.
+
+Every worker claims jobs from the shared queue, so a chart requested on one
+instance may be computed by another one.
+
+Keyword arguments:
+app -- Flask app, handler runs inside its app context
+handler -- computes the chart for a job payload
+count -- number of worker threads
+Return:
+the started threads
+"""
+def start_workers(app, handler: Callable[[dict], ChartDTO | None], count: int = CHART_WORKERS) -> list[threading.Thread]:
+    threads = []
+    for i in range(count):
+        worker_id = f"{socket.gethostname()}-{os.getpid()}-{i}"
+        thread = threading.Thread(target=_work, args=(app, handler, worker_id), name=f"chart-worker-{i}", daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads
+
+def _work(app, handler: Callable[[dict], ChartDTO | None], worker_id: str):
+    queue, cache = get_job_queue(), get_result_cache()
+    last_purge = 0.0
+    while True:
+        try:
+            if time.monotonic() - last_purge > PURGE_INTERVAL_SECONDS:
+                queue.purge(PURGE_INTERVAL_SECONDS)
+                cache.purge()
+                last_purge = time.monotonic()
+            job = queue.claim(worker_id)
+        except Exception as e:
+            print(f"Chart worker {worker_id} could not reach the job queue: {e}")
+            job = None
+        if job is None:
+            time.sleep(WORKER_POLL_SECONDS)
+            continue
+        try:
+            with app.app_context():
+                result = handler(job.payload)
+            cache.set(job.key, _chart_to_json(result), CHART_CACHE_TTL_SECONDS)
+            queue.complete(job.id)
+        except Exception as e:
+            kind = next((k for k, error in JOB_ERRORS.items() if isinstance(e, error)), "error")
+            queue.fail(job.id, kind, str(e))
+
+
+#Admission control: at most MAX_CONCURRENT_RSCRIPTS R processes on this host
+@contextmanager
+def rscript_slot():
+    deadline = time.monotonic() + ADMISSION_TIMEOUT_SECONDS
+    if fcntl is None:
+        if not _local_slots.acquire(timeout=ADMISSION_TIMEOUT_SECONDS):
+            raise ChartBusyError("Too many charts are being computed, try again later")
+        try:
+            yield
+        finally:
+            _local_slots.release()
+        return
+
+    Path(LOCKS_DIR).mkdir(parents=True, exist_ok=True)
+    slots = [open(Path(LOCKS_DIR) / f"rscript-slot-{i}.lock", "a") for i in range(MAX_CONCURRENT_RSCRIPTS)]
+    try:
+        while True:
+            held = next((s for s in slots if try_lock(s)), None)
+            if held is not None:
+                break
+            if time.monotonic() > deadline:
+                raise ChartBusyError("Too many charts are being computed, try again later")
+            time.sleep(LOCK_POLL_SECONDS)
+        try:
+            yield
+        finally:
+            unlock(held)
+    finally:
+        for s in slots:
+            s.close()
+
+
+#Exclusive lock shared by every process on the host, held while the block runs
+@contextmanager
+def named_lock(name: str):
+    with _named_locks_lock:
+        thread_lock = _named_locks.setdefault(name, threading.Lock())
+    Path(LOCKS_DIR).mkdir(parents=True, exist_ok=True)
+    with thread_lock, open(Path(LOCKS_DIR) / f"{name}.lock", "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            unlock(lock_file)
+
+
+#Non-blocking exclusive lock on an open lock file, always succeeds without fcntl
+def try_lock(lock_file) -> bool:
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB) # type: ignore
+        return True
+    except BlockingIOError:
+        return False
+
+def unlock(lock_file):
+    if fcntl is not None:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _chart_to_json(chart: ChartDTO | None) -> str:
+    if chart is None:
+        return "null"
+    d = asdict(chart)
+    d["start_date"] = chart.start_date.isoformat()
+    d["end_date"] = chart.end_date.isoformat()
+    return json.dumps(d)
+
+def _chart_from_json(text: str) -> ChartDTO | None:
+    d = json.loads(text)
+    if d is None:
+        return None
+    d["start_date"] = datetime.fromisoformat(d["start_date"])
+    d["end_date"] = datetime.fromisoformat(d["end_date"])
+    d["values"] = [
+        chartEntry(name=e["name"], values=[DataPoint(x=v["x"], y=v["y"]) for v in e["values"]])
+        for e in d["values"]
+    ]
+    return ChartDTO(**d)
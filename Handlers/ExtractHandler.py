@@ -0,0 +1,228 @@
+import os
+import shutil
+import time
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pandas as pd
+from models.db_models import DataFile
+from Handlers import ExecutionHandler
+from Handlers.UploadHandler import csv_separator
+
+# The forecast only looks at the last 60 days before the forecast start,
+# counted from the last sales row before it
+HISTORY_WINDOW = timedelta(days=60)
+EXTRACT_CHUNK_ROWS = 100_000
+MAX_EXTRACTS_PER_VISUALIZATION = 16
+EXTRACTS_ROOT = "./instance/extracts"
+# Longest an R run can still be reading an extract: waiting for a slot plus the run itself
+EXTRACT_GRACE_SECONDS = ExecutionHandler.ADMISSION_TIMEOUT_SECONDS + ExecutionHandler.RSCRIPT_TIMEOUT_SECONDS
+
+
+"""Prepares a directory with the data files of a visualization cut down to a date window.
+
+Keyword arguments:
+visualization_id -- id of the visualization the files belong to
+data_version -- current data version, extracts of older versions are dropped
+files -- current data files of the visualization
+start_date -- first date the caller needs (history included), None for the whole files
+end_date -- last date the caller needs, None for the whole files
+keep_last -- file name -> column, the last row of every value of column before the
+             window is kept too, so groups without rows in the window aren't lost
+Return: 
+path of the extract directory, with the uploaded file names
+"""
+def prepare_extract(visualization_id: int, data_version: int, files: list[DataFile], start_date: datetime | None, end_date: datetime | None,
+                    keep_last: dict[str, str] | None = None) -> str:
+    root = Path(EXTRACTS_ROOT) / str(visualization_id)
+    window = f"{start_date:%Y%m%d}_{end_date:%Y%m%d}" if start_date is not None and end_date is not None else "all"
+    extract_dir = root / f"v{data_version}_{window}"
+    if extract_dir.is_dir():
+        os.utime(extract_dir) # keep recently used extracts around
+        return extract_dir.as_posix()
+
+    root.mkdir(parents=True, exist_ok=True)
+    tmp_dir = root / f".{extract_dir.name}.{uuid.uuid4().hex}.tmp"
+    tmp_dir.mkdir()
+    try:
+        for f in files:
+            if start_date is None or end_date is None:
+                _whole_file(f, tmp_dir / f.name) # type: ignore
+            else:
+                # end_date is a day, every timestamp on that day belongs to the window
+                end_before = end_date.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+                _extract_file(f, tmp_dir / f.name, start_date, end_before, (keep_last or {}).get(f.name)) # type: ignore
+        os.rename(tmp_dir, extract_dir)
+    except OSError:
+        # Another request built the same extract first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not extract_dir.is_dir():
+            raise
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    _prune_extracts(root, data_version)
+    return extract_dir.as_posix()
+
+
+"""Returns the last date of a data file before a day, None when it has no rows before it.
+
+Only the date column is read, and only when the coverage doesn't answer it.
+
+Keyword arguments:
+f -- current data file with a detected date column
+day -- day the rows have to be before
+Return:
+the last date before day
+"""
+def last_date_before(f: DataFile, day: datetime) -> datetime | None:
+    if f.coverage_start is None or f.date_column is None or f.coverage_start >= day:
+        return None
+    if f.coverage_end < day: # type: ignore
+        return f.coverage_end # type: ignore
+    if f.partitioned:
+        # The last partition starting before day holds the answer
+        last = [p for p in f.partitions if p.coverage_start < day][-1]
+        if last.coverage_end < day:
+            return last.coverage_end # type: ignore
+        return _last_csv_date_before(last.file_path, f.date_column, day) # type: ignore
+    if Path(f.file_path).suffix.lower() == ".csv": # type: ignore
+        return _last_csv_date_before(f.file_path, f.date_column, day) # type: ignore
+    dates = pd.to_datetime(pd.read_excel(f.file_path, usecols=[f.date_column])[f.date_column], errors="coerce") # type: ignore
+    dates = dates[dates < day]
+    return dates.max().to_pydatetime() if len(dates) else None
+
+def _last_csv_date_before(path: str, date_column: str, day: datetime) -> datetime | None:
+    with open(path, "rb") as source:
+        sep = csv_separator(source.readline())
+    last = None
+    for chunk in pd.read_csv(path, sep=sep, usecols=[date_column], chunksize=EXTRACT_CHUNK_ROWS, encoding_errors="surrogateescape"):
+        dates = pd.to_datetime(chunk[date_column], errors="coerce")
+        before = dates[dates < day]
+        if len(before):
+            last = max(last, before.max()) if last is not None else before.max()
+        # Exports are written in date order, stop as soon as we are past the day
+        if dates.is_monotonic_increasing and dates.iloc[-1] >= day:
+            break
+    return last.to_pydatetime() if last is not None else None
+
+
+#Last row of every group before the extract window, kept for groups that have no rows in it
+@dataclass
+class _LastRows:
+    column: str
+    sep: str = ","
+    seen: set = field(default_factory=set)
+    rows: pd.DataFrame | None = None
+
+    def add(self, chunk: pd.DataFrame, in_window, before):
+        if self.column not in chunk.columns:
+            return
+        self.seen.update(chunk.loc[in_window, self.column])
+        earlier = chunk[before]
+        if len(earlier):
+            combined = earlier if self.rows is None else pd.concat([self.rows, earlier])
+            self.rows = combined.drop_duplicates(subset=[self.column], keep="last")
+
+    def write(self, target: Path):
+        if self.rows is None:
+            return
+        missing = self.rows[~self.rows[self.column].isin(self.seen)]
+        missing.to_csv(target, sep=self.sep, index=False, header=False, mode="a", errors="surrogateescape")
+
+
+def _extract_file(f: DataFile, target: Path, start_date: datetime, end_before: datetime, keep_column: str | None = None):
+    # Undated files (the model etc.) are needed as a whole
+    if f.coverage_start is None or f.date_column is None:
+        _link_or_copy(f.file_path, target) # type: ignore
+        return
+    keep = _LastRows(keep_column) if keep_column else None
+    if f.partitioned:
+        _extract_partitions(f, target, start_date, end_before, keep)
+    elif Path(f.file_path).suffix.lower() == ".csv": # type: ignore
+        # Groups are looked up in the rows before the window, so those are read even without an overlap
+        overlaps = keep is not None or (f.coverage_start < end_before and f.coverage_end >= start_date) # type: ignore
+        _extract_csv(f.file_path, f.date_column, target, start_date, end_before, overlaps, keep=keep) # type: ignore
+    else:
+        overlaps = f.coverage_start < end_before and f.coverage_end >= start_date # type: ignore
+        _extract_excel(f, target, start_date, end_before, overlaps)
+    if keep is not None:
+        keep.write(target)
+
+
+#Stored files have their own paths, R gets them under the uploaded name
+def _whole_file(f: DataFile, target: Path):
+    if f.partitioned:
+        _extract_partitions(f, target, f.coverage_start, f.coverage_end + timedelta(days=1)) # type: ignore
+    else:
+        _link_or_copy(f.file_path, target) # type: ignore
+
+
+#Appended datasets: only the monthly partitions overlapping the window are read, into one file.
+#Earlier partitions are only read to keep the last row of every group.
+def _extract_partitions(f: DataFile, target: Path, start_date: datetime, end_before: datetime, keep: _LastRows | None = None):
+    partitions = [p for p in f.partitions if p.coverage_start < end_before and p.coverage_end >= start_date]
+    if keep is not None:
+        partitions = [p for p in f.partitions if p.coverage_end < start_date] + partitions
+    if not partitions:
+        _extract_csv(f.partitions[0].file_path, f.date_column, target, start_date, end_before, overlaps=False) # type: ignore
+    for i, p in enumerate(partitions):
+        _extract_csv(p.file_path, f.date_column, target, start_date, end_before, overlaps=True, append=i > 0, keep=keep) # type: ignore
+
+
+def _extract_csv(path: str, date_column: str, target: Path, start_date: datetime, end_before: datetime, overlaps: bool, append: bool = False,
+                 keep: _LastRows | None = None):
+    with open(path, "rb") as source:
+        sep = csv_separator(source.readline())
+    if keep is not None:
+        keep.sep = sep
+    # Everything is kept as text so the values R reads are byte for byte the uploaded ones
+    read_args = dict(sep=sep, dtype=str, keep_default_na=False, encoding_errors="surrogateescape")
+    if not overlaps:
+        # Coverage tells us nothing is in the window, only the header is written
+        pd.read_csv(path, nrows=0, **read_args).to_csv(target, sep=sep, index=False, errors="surrogateescape") # type: ignore
+        return
+
+    for chunk in pd.read_csv(path, chunksize=EXTRACT_CHUNK_ROWS, **read_args): # type: ignore
+        dates = pd.to_datetime(chunk[date_column], errors="coerce")
+        in_window = (dates >= start_date) & (dates < end_before)
+        chunk[in_window].to_csv(
+            target, sep=sep, index=False, header=not append, mode="a" if append else "w", errors="surrogateescape"
+        )
+        append = True
+        if keep is not None:
+            keep.add(chunk, in_window, dates < start_date)
+        # Exports are written in date order, stop as soon as we are past the window
+        if dates.is_monotonic_increasing and dates.iloc[0] >= end_before:
+            break
+
+
+def _extract_excel(f: DataFile, target: Path, start_date: datetime, end_before: datetime, overlaps: bool):
+    df = pd.read_excel(f.file_path, nrows=None if overlaps else 0) # type: ignore
+    if overlaps:
+        dates = pd.to_datetime(df[f.date_column], errors="coerce")
+        df = df[(dates >= start_date) & (dates < end_before)]
+    df.to_excel(target, index=False)
+
+
+def _link_or_copy(source: str, target: Path):
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+#Drops extracts of older data versions and keeps the most recently used ones of the current version.
+#Extracts used within EXTRACT_GRACE_SECONDS are kept, an R run started before an upload may still read them.
+def _prune_extracts(root: Path, data_version: int):
+    extracts = [d for d in root.iterdir() if d.is_dir() and not d.name.startswith(".")]
+    current = [d for d in extracts if d.name.startswith(f"v{data_version}_")]
+    stale = [d for d in extracts if d not in current]
+    current.sort(key=lambda d: d.stat().st_mtime, reverse=True)
+    cutoff = time.time() - EXTRACT_GRACE_SECONDS
+    for d in stale + current[MAX_EXTRACTS_PER_VISUALIZATION:]:
+        if d.stat().st_mtime < cutoff:
+            shutil.rmtree(d, ignore_errors=True)
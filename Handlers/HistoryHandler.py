@@ -0,0 +1,177 @@
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+from models.db_models import DataFile, Visualization
+from models.dto_models import ChartDTO, DataPoint, chartEntry
+from Handlers.UploadHandler import csv_separator
+
+
+@dataclass
+class HistorySource:
+    file_name: str
+    aggregations: dict[str, str]  # value column -> "sum" or "mean"
+    group_column: str | None = None
+    series_name: str = "{}"  # formatted with the group value, or the column name when not grouped
+    date_column: str = "Date"
+
+
+# Historical (prediction=False) visualizations served without R, keyed by visualization id
+HISTORY_SOURCES = {
+    1: HistorySource(
+        file_name="sales_location_hourly.csv",
+        aggregations={"total": "sum"},
+        group_column="locationid",
+        series_name="Location_{}",
+    ),
+    2: HistorySource(
+        file_name="weather_data_hourly.csv",
+        aggregations={"Temperature": "mean", "Precipitation": "sum"},
+    ),
+}
+
+MAX_CACHED_FRAMES = 64 # one per data file or partition, daily frames are small
+
+_frames: OrderedDict[tuple, pd.DataFrame] = OrderedDict()
+_frames_lock = threading.Lock()
+
+
+def is_history_visualization(visualization: Visualization) -> bool:
+    return not visualization.prediction and visualization.id in HISTORY_SOURCES
+
+
+"""Builds a historical chart straight from the stored data file.
+
+Keyword arguments:
+visualization -- visualization listed in HISTORY_SOURCES
+files -- current data files of the visualization overlapping the range
+start_date -- first day of the chart
+end_date -- last day of the chart
+spread -- number of days aggregated into one point
+Return:
+ChartDTO object containing one series per group (or per value column)
+"""
+def get_history_chart(visualization: Visualization, files: list[DataFile], start_date: datetime, end_date: datetime, spread: int) -> ChartDTO:
+    values = list(history_entries(visualization, files, start_date, end_date, spread))
+    return ChartDTO(
+        visualization_id=visualization.id, # type: ignore
+        name=visualization.name, # type: ignore
+        prediction=visualization.prediction, # type: ignore
+        spread=spread,
+        start_date=start_date,
+        end_date=end_date,
+        values=values,
+    )
+
+
+#Yields the series of a historical chart one by one, for streamed responses
+def history_entries(visualization: Visualization, files: list[DataFile], start_date: datetime, end_date: datetime, spread: int) -> Iterator[chartEntry]:
+    source = HISTORY_SOURCES[visualization.id] # type: ignore
+    data_file = next((f for f in files if f.name == source.file_name), None)
+    if data_file is not None:
+        daily = _daily_frame(data_file, source, start_date, end_date)
+        yield from _chart_entries(daily, source, start_date, end_date, spread)
+
+
+def _chart_entries(daily: pd.DataFrame, source: HistorySource, start_date: datetime, end_date: datetime, spread: int) -> Iterator[chartEntry]:
+    first_day = np.datetime64(start_date.date(), "D")
+    days = daily["day"].to_numpy()
+    # daily is sorted by day, so the range is two binary searches
+    lo = np.searchsorted(days, first_day, side="left")
+    hi = np.searchsorted(days, np.datetime64(end_date.date(), "D"), side="right")
+    window = daily.iloc[lo:hi]
+    if window.empty:
+        return
+
+    # Every point covers `spread` days counted from the requested start date
+    bucket = (window["day"].to_numpy() - first_day).astype("timedelta64[D]").astype(np.int64) // spread
+    keys = [bucket] if source.group_column is None else [window[source.group_column].to_numpy(), bucket]
+    grouped = window.drop(columns=["day"] + ([source.group_column] if source.group_column else [])).groupby(keys).sum()
+
+    for column, how in source.aggregations.items():
+        grouped[column] = grouped[f"{column}__sum"] / grouped[f"{column}__count"] if how == "mean" else grouped[f"{column}__sum"]
+
+    if source.group_column is None:
+        x = [_bucket_label(first_day, b, spread) for b in grouped.index]
+        for column in source.aggregations:
+            yield chartEntry(
+                name=source.series_name.format(column),
+                values=[DataPoint(x=label, y=float(y)) for label, y in zip(x, grouped[column].to_numpy())],
+            )
+        return
+
+    for group, rows in grouped.groupby(level=0, sort=True):
+        x = [_bucket_label(first_day, b, spread) for b in rows.index.get_level_values(1)]
+        for column in source.aggregations:
+            name = source.series_name.format(group)
+            if len(source.aggregations) > 1:
+                name = f"{name} {column}"
+            yield chartEntry(
+                name=name,
+                values=[DataPoint(x=label, y=float(y)) for label, y in zip(x, rows[column].to_numpy())],
+            )
+
+
+def _bucket_label(first_day: np.datetime64, bucket: int, spread: int) -> str:
+    return str(first_day + np.timedelta64(int(bucket) * spread, "D"))
+
+
+#Returns the data file aggregated to one row per day (and group)
+def _daily_frame(data_file: DataFile, source: HistorySource, start_date: datetime, end_date: datetime) -> pd.DataFrame:
+    date_column = data_file.date_column or source.date_column
+    if not data_file.partitioned:
+        return _cached_frame(("file", data_file.id), data_file.file_path, date_column, source) # type: ignore
+    # Appended datasets are cached per partition version, an append only reloads the months it changed.
+    # A day never spans two months, so the daily rows of the partitions simply add up.
+    partitions = [
+        p for p in data_file.partitions
+        if p.coverage_start.date() <= end_date.date() and p.coverage_end.date() >= start_date.date()
+    ] or data_file.partitions[:1]
+    return pd.concat([
+        _cached_frame(("partition", p.id, p.content_hash), p.file_path, date_column, source) # type: ignore
+        for p in partitions
+    ], ignore_index=True)
+
+def _cached_frame(key: tuple, path: str, date_column: str, source: HistorySource) -> pd.DataFrame:
+    with _frames_lock:
+        daily = _frames.get(key)
+        if daily is not None:
+            _frames.move_to_end(key)
+            return daily
+
+    daily = _load_daily_frame(path, date_column, source)
+
+    with _frames_lock:
+        _frames[key] = daily
+        while len(_frames) > MAX_CACHED_FRAMES:
+            _frames.popitem(last=False)
+    return daily
+
+
+def _load_daily_frame(file_path: str, date_column: str, source: HistorySource) -> pd.DataFrame:
+    columns = [date_column] + list(source.aggregations) + ([source.group_column] if source.group_column else [])
+    path = Path(file_path)
+    if path.suffix.lower() == ".csv":
+        with open(path, "rb") as f:
+            sep = csv_separator(f.readline())
+        # ';' separated exports are read.csv2 style and use a decimal comma
+        df = pd.read_csv(path, sep=sep, decimal="," if sep == ";" else ".", usecols=columns)
+    else:
+        df = pd.read_excel(path, usecols=columns)
+
+    df["day"] = pd.to_datetime(df[date_column], errors="coerce").dt.floor("D")
+    df = df.dropna(subset=["day"])
+    # Sums and counts add up across buckets, so means stay exact when days are merged
+    aggregations = {}
+    for column in source.aggregations:
+        df[column] = pd.to_numeric(df[column], errors="coerce")
+        aggregations[f"{column}__sum"] = (column, "sum")
+        aggregations[f"{column}__count"] = (column, "count")
+    keys = ["day"] + ([source.group_column] if source.group_column else [])
+    daily = df.groupby(keys, sort=False).agg(**aggregations).reset_index()
+    return daily.sort_values("day", kind="stable").reset_index(drop=True)
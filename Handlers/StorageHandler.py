@@ -0,0 +1,201 @@
+import gzip
+import os
+import shutil
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import delete, func, select, update
+from models.db_models import DataFile, DataPartition, File, Visualization, VisualizationSummary
+from Handlers import ExecutionHandler
+from backends.factory import get_file_store
+
+try:
+    import zstandard
+except ImportError: # optional, superseded files are gzipped without it
+    zstandard = None
+
+DEFAULT_KEEP_VERSIONS = int(os.environ.get("DEFAULT_KEEP_VERSIONS", 5))
+COMPACTION_INTERVAL_SECONDS = float(os.environ.get("COMPACTION_INTERVAL_SECONDS", 3600)) # 0 disables the background job
+COPY_CHUNK_BYTES = 1024 * 1024
+PARTITION_GRACE_SECONDS = 600 # replaced partition files are kept this long for readers of the previous version
+COMPRESSED_SUFFIXES = {"zstd": ".zst", "gzip": ".gz"}
+
+
+#Opens a stored file for reading, decompressing it transparently
+def open_stored(f: File):
+    if f.compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read this file")
+        return zstandard.ZstdDecompressor().stream_reader(open(f.file_path, "rb"), closefd=True) # type: ignore
+    if f.compression == "gzip":
+        return gzip.open(f.file_path, "rb") # type: ignore
+    return open(f.file_path, "rb") # type: ignore
+
+
+"""Applies the retention policy to superseded data files.
+
+Superseded versions outside retention are deleted together with their rows,
+rows whose bytes no longer exist are pruned, and the remaining superseded
+versions are compressed. Partition files replaced by appends are deleted.
+
+Keyword arguments:
+db -- SQLAlchemy database session
+Return:
+counts of what was pruned and compressed
+"""
+def compact_storage(db: SQLAlchemy) -> dict:
+    stats = {"pruned": 0, "compressed": 0, "partitions_swept": 0, "bytes_freed": 0}
+    for vis in db.session.query(Visualization).all():
+        keep_versions = vis.retention_versions if vis.retention_versions is not None else DEFAULT_KEEP_VERSIONS
+        oldest_kept = datetime.now() - timedelta(days=vis.retention_days) if vis.retention_days is not None else None # type: ignore
+        files = db.session.query(DataFile).filter(DataFile.visualization_id == vis.id).order_by(DataFile.id.desc()).all() # type: ignore
+        # Bytes are only deleted once the rows no longer point at them
+        unlink: list[str] = []
+
+        by_name: dict[str, list[DataFile]] = {}
+        for f in files:
+            by_name.setdefault(f.name, []).append(f) # type: ignore
+        for versions in by_name.values():
+            current, superseded = versions[0], versions[1:]
+            for rank, f in enumerate(superseded, start=1):
+                newer = versions[rank - 1]
+                # Rows from before versioning all point at the current file, their bytes are gone
+                lost = f.file_path == current.file_path or not os.path.isfile(f.file_path) # type: ignore
+                expired = rank > keep_versions or (oldest_kept is not None and f.upload_time < oldest_kept)
+                if lost or expired:
+                    stats["bytes_freed"] += _remove(f, newer, lost, db, unlink)
+                    stats["pruned"] += 1
+                elif f.compression is None:
+                    stats["bytes_freed"] += _compress(f, unlink)
+                    stats["compressed"] += 1
+        _sweep_partitions(vis.id, db, stats) # type: ignore
+        db.session.flush()
+        refresh_summary_coverage(vis.id, db) # type: ignore
+        db.session.commit()
+        for path in unlink:
+            try:
+                os.remove(path)
+            except OSError as e: # left behind, the row doesn't reference it anymore
+                print(f"Could not delete {path}: {e}")
+    return stats
+
+
+#Deletes partition files no partition row points at anymore
+def _sweep_partitions(visualization_id: int, db: SQLAlchemy, stats: dict):
+    datasets_dir = Path(get_file_store().path(str(visualization_id), "datasets"))
+    if not datasets_dir.is_dir():
+        return
+    referenced = {os.path.normpath(path) for path, in db.session.query(DataPartition.file_path).filter(
+        DataPartition.visualization_id == visualization_id, # type: ignore
+    )}
+    cutoff = time.time() - PARTITION_GRACE_SECONDS
+    for dataset_dir in datasets_dir.iterdir():
+        by_month: dict[str, list[Path]] = {}
+        for path in dataset_dir.glob("*.csv"):
+            by_month.setdefault(path.name.split(".")[0], []).append(path)
+        for paths in by_month.values():
+            # The newest file of a month is the one that replaced the others
+            if max(p.stat().st_mtime for p in paths) >= cutoff:
+                continue
+            for path in paths:
+                if os.path.normpath(path) not in referenced:
+                    stats["bytes_freed"] += path.stat().st_size
+                    stats["partitions_swept"] += 1
+                    path.unlink()
+
+
+#Sets the summary's covered range to the one of the current data files, like get_visualization_max_timespan
+def refresh_summary_coverage(visualization_id: int, db: SQLAlchemy):
+    current_ids = select(func.max(DataFile.id)).where(DataFile.visualization_id == visualization_id).group_by(DataFile.name)
+    current = (DataFile.visualization_id == visualization_id, DataFile.id.in_(current_ids))
+    db.session.execute(
+        update(VisualizationSummary).where(VisualizationSummary.visualization_id == visualization_id).values({
+            VisualizationSummary.coverage_start: select(func.min(DataFile.coverage_start)).where(*current).scalar_subquery(),
+            VisualizationSummary.coverage_end: select(func.max(DataFile.coverage_end)).where(*current).scalar_subquery(),
+        }),
+        execution_options={"synchronize_session": False},
+    )
+
+
+#Deletes the rows of a superseded file, its bytes are added to unlink
+def _remove(f: DataFile, newer: DataFile, lost: bool, db: SQLAlchemy, unlink: list[str]) -> int:
+    freed = 0
+    if not lost and os.path.isfile(f.file_path): # type: ignore
+        freed = os.path.getsize(f.file_path) # type: ignore
+        unlink.append(f.file_path) # type: ignore
+    # Appended datasets are counted once and their bytes are the partitions', which appends account for
+    count = (0 if newer.partitioned else 1) if f.partitioned else 1
+    size = 0 if f.partitioned else (f.size_bytes or 0)
+    db.session.execute(
+        update(VisualizationSummary).where(VisualizationSummary.visualization_id == f.visualization_id).values({
+            VisualizationSummary.data_files_count: func.max(0, VisualizationSummary.data_files_count - count),
+            VisualizationSummary.total_bytes: func.max(0, VisualizationSummary.total_bytes - size),
+        }),
+        execution_options={"synchronize_session": False},
+    )
+    # DataFile.file points back at its own row, which the ORM can't order for a delete
+    db.session.execute(delete(DataFile.__table__).where(DataFile.__table__.c.id == f.id))
+    db.session.execute(delete(File.__table__).where(File.__table__.c.id == f.id))
+    db.session.expunge(f)
+    return freed
+
+#Compresses a superseded file next to itself and repoints its row, returns the bytes saved.
+#The uncompressed file is added to unlink.
+def _compress(f: DataFile, unlink: list[str]) -> int:
+    compression = "zstd" if zstandard is not None else "gzip"
+    target = f"{f.file_path}{COMPRESSED_SUFFIXES[compression]}"
+    with open(f.file_path, "rb") as source: # type: ignore
+        if compression == "zstd":
+            with open(target, "wb") as out:
+                zstandard.ZstdCompressor(level=10).copy_stream(source, out) # type: ignore
+        else:
+            with gzip.open(target, "wb") as out:
+                shutil.copyfileobj(source, out, COPY_CHUNK_BYTES)
+    saved = os.path.getsize(f.file_path) - os.path.getsize(target) # type: ignore
+    unlink.append(f.file_path) # type: ignore
+    f.file_path = target # type: ignore
+    f.compression = compression # type: ignore
+    return saved
+
+
+"""Runs compact_storage unless another process on the host is already compacting.
+
+Keyword arguments:
+db -- SQLAlchemy database session
+Return:
+the stats of compact_storage, None when the compaction lock is held
+"""
+def try_compact_storage(db: SQLAlchemy) -> dict | None:
+    Path(ExecutionHandler.LOCKS_DIR).mkdir(parents=True, exist_ok=True)
+    with open(Path(ExecutionHandler.LOCKS_DIR) / "compaction.lock", "a") as lock_file:
+        if not ExecutionHandler.try_lock(lock_file):
+            return None
+        try:
+            return compact_storage(db)
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            ExecutionHandler.unlock(lock_file)
+
+
+#Runs compact_storage every COMPACTION_INTERVAL_SECONDS, only one process per host does the work
+def start_compaction_thread(app, db: SQLAlchemy):
+    if COMPACTION_INTERVAL_SECONDS <= 0:
+        return None
+
+    def loop():
+        while True:
+            try:
+                with app.app_context():
+                    try_compact_storage(db)
+            except Exception as e:
+                print(f"Storage compaction failed: {e}")
+            time.sleep(COMPACTION_INTERVAL_SECONDS)
+
+    thread = threading.Thread(target=loop, name="storage-compaction", daemon=True)
+    thread.start()
+    return thread
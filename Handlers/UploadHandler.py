@@ -1,12 +1,22 @@
+import hashlib
 import io
-from flask import Response, jsonify, url_for
+import os
+import zlib
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from flask import Response, jsonify, request, send_file, url_for
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import func, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 import pandas as pd
-from requests import request
-from models.db_models import File, DataFile, RScriptFile, Visualization
-from models.dto_models import FileQuery, FileUploadQuery, FileDTO
+from models.db_models import File, DataFile, DataPartition, RScriptFile, Visualization, VisualizationSummary
+from models.dto_models import BundleUploadQuery, FileQuery, FileUploadQuery, FileDTO, PartitionDTO
 from pathlib import Path
-from datetime import timedelta
+from werkzeug.datastructures import FileStorage
+from Handlers import ExecutionHandler, StorageHandler
+from backends.factory import get_file_store
+from datetime import datetime, timedelta
 
 REQUIRED_SALES_HEADERS = [
     "ReceiptDateTime", "ArticleId", "NetAmountExcl",
@@ -24,6 +34,12 @@ HEADERS_TO_ID = {
 
 SAMPLE_ROWS = 1000
 MAX_WARN_ROWS_SHOWN = 10
+BUNDLE_WORKERS = 6 # the forecasting bundle has six files
+MAX_BUNDLE_UNCOMPRESSED_BYTES = int(os.environ.get("MAX_BUNDLE_UNCOMPRESSED_BYTES", 1024 * 1024 * 1024))
+DOWNLOAD_CHUNK_BYTES = 256 * 1024
+DATE_COLUMN_HINTS = ("date", "datum", "time")
+# Appended rows are kept as text so partitions hold the uploaded values byte for byte
+PARTITION_READ_ARGS = dict(dtype=str, keep_default_na=False, encoding_errors="surrogateescape")
 
 
 #Return set of lowercased column names for case-insensitive comparison.
@@ -46,7 +62,6 @@ def upload_data_file(query: FileUploadQuery, db: SQLAlchemy):
         # Try read sample from file
         try:
             content = file.read()
-            sample_buf = io.BytesIO(content)
         except Exception as e:
             return jsonify({"status": "rejected", "errors": [f"Failed to read uploaded file: {str(e)}"]}), 400
         
@@ -76,44 +91,463 @@ def upload_data_file(query: FileUploadQuery, db: SQLAlchemy):
         #     return jsonify({"status": "rejected", "errors": errors}), 400
         
         # # Read a sample of rows for content validation
-        try:
-            file_type = Path(file.filename).suffix.lower() # type: ignore
-            if file_type == ".csv":
-                sample_df = pd.read_csv(sample_buf, nrows=SAMPLE_ROWS, sep=";")
-            elif file_type in [".xls", ".xlsx"]:
-                sample_df = pd.read_excel(sample_buf, nrows=SAMPLE_ROWS)
-            elif file_type in [".rds", ".rda"]: # we have to accept these but we won't parse them here
-                sample_df = []
-            else:
-                return jsonify({"status": "rejected", "errors": [f"Unsupported file type: {file_type}"]}), 400
-        except Exception as e:
-            return jsonify({"status": "rejected", "errors": [f"Failed to parse sample rows: {str(e)}"]}), 400
+        sample_df, error = _validate_data_file(file.filename, content) # type: ignore
+        if error:
+            return jsonify({"status": "rejected", "errors": [error]}), 400
+        date_column, coverage_start, coverage_end = _detect_coverage(file.filename, content, sample_df) # type: ignore
         
         
         # If we got here, everything is fine. Save the file to disk.
+        tmp_path = None
+        placed: list[str] = []
         try:
-            Path(f"./instance/store/{query.visualization_id}/data").mkdir(parents=True, exist_ok=True)
-            file_path = f"./instance/store/{query.visualization_id}/data/{file.filename}"
-            with open(file_path, "wb") as f:
-                f.write(content)
+            store = get_file_store()
+            data_dir = Path(store.ensure_dir(str(query.visualization_id), "data"))
+            tmp_path = _stage_file(data_dir, file.filename, content) # type: ignore
             
-
+            # The version we replace keeps its own path and is later compressed by the compaction
             new_data_file = DataFile(
                 name=file.filename, # type: ignore
-                file_path=file_path,
-                timespan= timedelta(days=1), # Placeholder, real timespan calculation needed # type: ignore
+                file_path=tmp_path.as_posix(),
+                timespan=_timespan(coverage_start, coverage_end), # type: ignore
                 rows_count=len(sample_df),
                 extension=Path(file.filename).suffix, # type: ignore
                 visualization_id=query.visualization_id,
+                data_version=_next_data_version(query.visualization_id, db),
+                size_bytes=len(content),
+                content_hash=hashlib.sha256(content).hexdigest(),
+                coverage_start=coverage_start,
+                coverage_end=coverage_end,
+                date_column=date_column,
             )
             
             db.session.add(new_data_file)
+            _place_file(new_data_file, tmp_path, placed, db)
+            _update_summary(query.visualization_id, new_data_file, db)
             db.session.commit()
         except Exception as e:
+            db.session.rollback()
+            for path in [tmp_path, *placed]:
+                if path is not None:
+                    Path(path).unlink(missing_ok=True)
             return jsonify({"status": "rejected", "errors": [f"Failed to save file: {str(e)}"]}), 500
 
         #Return success marker.
         return jsonify({"status": "ok", "message": "File added successfully"}), 200
+
+
+"""Appends the rows of an uploaded CSV to a dataset partitioned by month.
+
+Only the months the upload touches are read and rewritten: new rows are
+merged into them and rows with the same key are de-duplicated, the newest
+upload wins. A dataset uploaded as one file before is split into partitions
+on its first append. Changed partitions are flagged dirty and get the new
+data version, appends that change nothing don't bump it.
+
+Keyword arguments:
+query -- FileUploadQuery with mode "append" and optional key_columns
+db -- SQLAlchemy database session
+Return:
+Flask response with the new data version and the changed months
+"""
+def append_data_file(query: FileUploadQuery, db: SQLAlchemy):
+    file = query.file
+    vis = db.session.get(Visualization, query.visualization_id)
+    if not vis:
+        return jsonify({"status": "rejected", "errors": ["Visualization not found"]}), 404
+    if Path(file.filename).suffix.lower() != ".csv": # type: ignore
+        return jsonify({"status": "rejected", "errors": ["Append mode only supports .csv files."]}), 400
+
+    try:
+        content = file.read()
+    except Exception as e:
+        return jsonify({"status": "rejected", "errors": [f"Failed to read uploaded file: {str(e)}"]}), 400
+    sample_df, error = _validate_data_file(file.filename, content) # type: ignore
+    if error:
+        return jsonify({"status": "rejected", "errors": [error]}), 400
+    try:
+        delta = pd.read_csv(io.BytesIO(content), sep=csv_separator(content), **PARTITION_READ_ARGS) # type: ignore
+    except Exception as e:
+        return jsonify({"status": "rejected", "errors": [f"Failed to parse rows: {str(e)}"]}), 400
+
+    # Appends to one dataset are serialized, each one rewrites the partitions the last one wrote
+    with ExecutionHandler.named_lock(f"dataset-{vis.id}-{Path(file.filename).stem}"): # type: ignore
+        return _append_rows(vis, file.filename, delta, csv_separator(content), sample_df, query.key_columns, db) # type: ignore
+
+
+def _append_rows(vis: Visualization, name: str, delta: pd.DataFrame, sep: str, sample_df: pd.DataFrame, key_columns: list[str] | None, db: SQLAlchemy):
+    current = db.session.query(DataFile).filter(
+        DataFile.visualization_id == vis.id, # type: ignore
+        DataFile.name == name, # type: ignore
+    ).order_by(DataFile.id.desc()).first()
+    partitions = {p.month: p for p in db.session.query(DataPartition).filter(
+        DataPartition.visualization_id == vis.id, # type: ignore
+        DataPartition.dataset == name, # type: ignore
+    )}
+
+    date_column = current.date_column if current is not None and current.date_column else _find_date_column(sample_df)
+    if date_column is None or date_column not in delta.columns:
+        return jsonify({"status": "rejected", "errors": ["Append mode needs a date column to partition by."]}), 400
+    key_columns = key_columns or list(delta.columns)
+    missing = [c for c in key_columns if c not in delta.columns]
+    if missing:
+        return jsonify({"status": "rejected", "errors": [f"Unknown key columns: {', '.join(missing)}"]}), 400
+
+    stale: list[DataPartition] = []
+    base_rows = 0
+    if current is not None and not current.partitioned:
+        # First append to a dataset uploaded as one file, its rows go in before the new ones
+        with StorageHandler.open_stored(current) as f:
+            base_content = f.read()
+        base = pd.read_csv(io.BytesIO(base_content), sep=csv_separator(base_content), **PARTITION_READ_ARGS) # type: ignore
+        if set(base.columns) != set(delta.columns):
+            return jsonify({"status": "rejected", "errors": ["Columns don't match the stored dataset."]}), 400
+        delta = pd.concat([base, delta[base.columns]], ignore_index=True)
+        sep = csv_separator(base_content)
+        base_rows = len(base)
+        # Partitions left from before the dataset was replaced by a full upload
+        stale, partitions = list(partitions.values()), {}
+    elif partitions:
+        first_path = next(iter(partitions.values())).file_path
+        with open(first_path, "rb") as f: # type: ignore
+            sep = csv_separator(f.readline())
+        if set(pd.read_csv(first_path, sep=sep, nrows=0, **PARTITION_READ_ARGS).columns) != set(delta.columns): # type: ignore
+            return jsonify({"status": "rejected", "errors": ["Columns don't match the stored dataset."]}), 400
+
+    dates = pd.to_datetime(delta[date_column], errors="coerce")
+    undated = int(dates.isna().sum())
+    if undated:
+        return jsonify({"status": "rejected", "errors": [f"{undated} rows have no valid date in column {date_column}."]}), 400
+
+    store = get_file_store()
+    stem = Path(name).stem
+    version = None
+    changed: list[str] = []
+    rows_added = 0
+    bytes_added = 0 # written partitions minus the ones they replace, the rest is shared with the previous version
+    written: list[str] = []
+    try:
+        for p in stale:
+            bytes_added -= p.size_bytes or 0
+            db.session.delete(p)
+        db.session.flush()
+        store.ensure_dir(str(vis.id), "datasets", stem)
+        for month, rows in delta.groupby(dates.dt.strftime("%Y-%m").to_numpy(), sort=True):
+            partition = partitions.get(month)
+            merged = rows
+            if partition is not None:
+                stored = pd.read_csv(partition.file_path, sep=sep, **PARTITION_READ_ARGS) # type: ignore
+                if set(stored.columns) != set(rows.columns):
+                    raise ValueError("Columns don't match the stored dataset.")
+                merged = pd.concat([stored, rows[stored.columns]], ignore_index=True)
+            # Re-sent rows replace the stored ones, the newest upload wins
+            merged = merged.drop_duplicates(subset=key_columns, keep="last")
+            merged_dates = pd.to_datetime(merged[date_column], errors="coerce")
+            order = merged_dates.argsort(kind="stable")
+            merged, merged_dates = merged.iloc[order], merged_dates.iloc[order]
+            data = merged.to_csv(sep=sep, index=False).encode("utf-8", "surrogateescape")
+            content_hash = hashlib.sha256(data).hexdigest()
+            if partition is not None and partition.content_hash == content_hash:
+                continue
+
+            if version is None:
+                version = _next_data_version(vis.id, db) # type: ignore
+            # Partition files are never overwritten, readers of the previous version keep theirs
+            file_path = store.path(str(vis.id), "datasets", stem, f"{month}.v{version}.csv")
+            with open(file_path, "wb") as f:
+                f.write(data)
+            written.append(file_path)
+            if partition is None:
+                partition = DataPartition(visualization_id=vis.id, dataset=name, month=month) # type: ignore
+                db.session.add(partition)
+            rows_added += len(merged) - (partition.rows_count or 0)
+            bytes_added += len(data) - (partition.size_bytes or 0)
+            partition.file_path = file_path # type: ignore
+            partition.rows_count = len(merged) # type: ignore
+            partition.size_bytes = len(data) # type: ignore
+            partition.content_hash = content_hash # type: ignore
+            partition.coverage_start = merged_dates.iloc[0].to_pydatetime() # type: ignore
+            partition.coverage_end = merged_dates.iloc[-1].to_pydatetime() # type: ignore
+            partition.data_version = version # type: ignore
+            partition.dirty = True # type: ignore
+            partition.updated_time = datetime.now() # type: ignore
+            changed.append(month)
+
+        if version is None:
+            db.session.rollback()
+            return jsonify({"status": "ok", "message": "No new rows", "data_version": vis.data_version, "partitions_changed": []}), 200
+        db.session.flush()
+
+        current_partitions = db.session.query(DataPartition).filter(
+            DataPartition.visualization_id == vis.id, # type: ignore
+            DataPartition.dataset == name, # type: ignore
+        ).all()
+        coverage_start = min(p.coverage_start for p in current_partitions)
+        coverage_end = max(p.coverage_end for p in current_partitions)
+        # The dataset is one data file row like any upload, pointing at its partitions directory
+        new_data_file = DataFile(
+            name=name,
+            file_path=store.path(str(vis.id), "datasets", stem),
+            timespan=_timespan(coverage_start, coverage_end), # type: ignore
+            rows_count=sum(p.rows_count for p in current_partitions), # type: ignore
+            extension=".csv",
+            visualization_id=vis.id, # type: ignore
+            data_version=version,
+            size_bytes=sum(p.size_bytes for p in current_partitions), # type: ignore
+            coverage_start=coverage_start, # type: ignore
+            coverage_end=coverage_end, # type: ignore
+            date_column=date_column,
+        )
+        new_data_file.partitioned = True # type: ignore
+        db.session.add(new_data_file)
+        # Appending to an appended dataset adds no file to the catalog
+        _update_summary(vis.id, new_data_file, db, size_bytes=bytes_added, counted=current is None or not current.partitioned) # type: ignore
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        for path in written:
+            Path(path).unlink(missing_ok=True)
+        return jsonify({"status": "rejected", "errors": [f"Failed to append rows: {str(e)}"]}), 500
+
+    # Replaced partition files are swept by the storage compaction once no reader needs them
+    return jsonify({
+        "status": "ok",
+        "message": "Rows appended successfully",
+        "data_version": version,
+        "partitions_changed": changed,
+        "rows_added": rows_added - base_rows,
+    }), 200
+
+
+# Uploads a whole set of data files (multipart or a single .zip) as one data version.
+# Members are validated and written in parallel, then registered in one transaction,
+# so readers never see a half-updated set.
+def upload_data_bundle(query: BundleUploadQuery, db: SQLAlchemy):
+    vis = db.session.get(Visualization, query.visualization_id)
+    if not vis:
+        return jsonify({"status": "rejected", "errors": ["Visualization not found"]}), 404
+
+    try:
+        members = _read_bundle_members(query.files)
+    except Exception as e:
+        return jsonify({"status": "rejected", "errors": [f"Failed to read uploaded bundle: {str(e)}"]}), 400
+    if not members:
+        return jsonify({"status": "rejected", "errors": ["Bundle contains no files."]}), 400
+
+    names = [name for name, _ in members]
+    duplicates = sorted({n for n in names if names.count(n) > 1})
+    if duplicates:
+        return jsonify({"status": "rejected", "errors": [f"Duplicate files in bundle: {', '.join(duplicates)}"]}), 400
+
+    with ThreadPoolExecutor(max_workers=min(BUNDLE_WORKERS, len(members))) as pool:
+        validated = list(pool.map(lambda m: _validate_data_file(m[0], m[1]), members))
+        coverages = list(pool.map(lambda mv: _detect_coverage(mv[0][0], mv[0][1], mv[1][0]), zip(members, validated)))
+    errors = [f"{name}: {error}" for (name, _), (_, error) in zip(members, validated) if error]
+    if errors:
+        return jsonify({"status": "rejected", "errors": errors}), 400
+
+    store = get_file_store()
+    staged: list[Path] = []
+    placed: list[str] = []
+    try:
+        data_dir = Path(store.ensure_dir(str(query.visualization_id), "data"))
+        # Stage every member next to its final location, nothing is visible yet
+        with ThreadPoolExecutor(max_workers=min(BUNDLE_WORKERS, len(members))) as pool:
+            staged = list(pool.map(lambda m: _stage_file(data_dir, m[0], m[1]), members))
+
+        version = _next_data_version(query.visualization_id, db)
+        for (name, content), (sample_df, _), (date_column, coverage_start, coverage_end), tmp_path in zip(members, validated, coverages, staged):
+            new_data_file = DataFile(
+                name=name,
+                file_path=tmp_path.as_posix(),
+                timespan=_timespan(coverage_start, coverage_end), # type: ignore
+                rows_count=len(sample_df),
+                extension=Path(name).suffix,
+                visualization_id=query.visualization_id,
+                data_version=version,
+                size_bytes=len(content),
+                content_hash=hashlib.sha256(content).hexdigest(),
+                coverage_start=coverage_start,
+                coverage_end=coverage_end,
+                date_column=date_column,
+            )
+            db.session.add(new_data_file)
+            _place_file(new_data_file, tmp_path, placed, db)
+            _update_summary(query.visualization_id, new_data_file, db)
+        # The only switch: readers see either all the new files or none of them
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        for path in [*staged, *placed]:
+            Path(path).unlink(missing_ok=True)
+        return jsonify({"status": "rejected", "errors": [f"Failed to save bundle: {str(e)}"]}), 500
+
+    return jsonify({"status": "ok", "message": f"Bundle of {len(members)} files added successfully", "data_version": version}), 200
+
+
+#Returns (filename, content) pairs, expanding a single uploaded .zip archive
+def _read_bundle_members(files: list[FileStorage]) -> list[tuple[str, bytes]]:
+    if len(files) == 1 and Path(files[0].filename or "").suffix.lower() == ".zip":
+        members = []
+        with zipfile.ZipFile(io.BytesIO(files[0].read())) as archive:
+            # MAX_CONTENT_LENGTH only limits the compressed upload, check what it expands to before reading
+            total = sum(info.file_size for info in archive.infolist())
+            if total > MAX_BUNDLE_UNCOMPRESSED_BYTES:
+                raise ValueError(f"archive expands to {total} bytes, the limit is {MAX_BUNDLE_UNCOMPRESSED_BYTES}")
+            for info in archive.infolist():
+                name = Path(info.filename).name
+                if info.is_dir() or not name or name.startswith("."):
+                    continue
+                members.append((name, archive.read(info)))
+        return members
+    return [(Path(f.filename or "").name, f.read()) for f in files]
+
+#Parses a sample of the file, returns (sample, None) or (None, error message)
+def _validate_data_file(filename: str, content: bytes):
+    try:
+        sample_buf = io.BytesIO(content)
+        file_type = Path(filename).suffix.lower()
+        if file_type == ".csv":
+            sample_df = pd.read_csv(sample_buf, nrows=SAMPLE_ROWS, sep=csv_separator(content))
+        elif file_type in [".xls", ".xlsx"]:
+            sample_df = pd.read_excel(sample_buf, nrows=SAMPLE_ROWS)
+        elif file_type in [".rds", ".rda"]: # we have to accept these but we won't parse them here
+            sample_df = []
+        else:
+            return None, f"Unsupported file type: {file_type}"
+    except Exception as e:
+        return None, f"Failed to parse sample rows: {str(e)}"
+    return sample_df, None
+
+#Our exports mix ';' (read.csv2) and ',' (read.csv) separated files, sniff it from the header
+def csv_separator(content: bytes) -> str:
+    header = content[:content.find(b"\n")] if b"\n" in content else content
+    return "," if header.count(b",") > header.count(b";") else ";"
+
+#Picks the first column that looks like a date column and parses in the sample
+def _find_date_column(sample_df: pd.DataFrame) -> str | None:
+    for column in sample_df.columns:
+        if not any(hint in str(column).lower() for hint in DATE_COLUMN_HINTS):
+            continue
+        parsed = pd.to_datetime(sample_df[column], errors="coerce")
+        if len(parsed) and parsed.notna().mean() > 0.9:
+            return column
+    return None
+
+#Returns the (date column, first, last date) of a data file, all None when it has no date column
+def _detect_coverage(filename: str, content: bytes, sample_df) -> tuple[str | None, datetime | None, datetime | None]:
+    if not isinstance(sample_df, pd.DataFrame):
+        return None, None, None
+    column = _find_date_column(sample_df)
+    if column is None:
+        return None, None, None
+    try:
+        # Only the date column is read from the full file
+        if Path(filename).suffix.lower() == ".csv":
+            dates = pd.read_csv(io.BytesIO(content), usecols=[column], sep=csv_separator(content))[column]
+        else:
+            dates = pd.read_excel(io.BytesIO(content), usecols=[column])[column]
+        dates = pd.to_datetime(dates, errors="coerce").dropna()
+    except Exception:
+        return None, None, None
+    if dates.empty:
+        return None, None, None
+    return column, dates.min().to_pydatetime(), dates.max().to_pydatetime()
+
+def _timespan(start: datetime | None, end: datetime | None) -> timedelta | None:
+    if start is None or end is None:
+        return None
+    return end - start
+
+#Applies a new upload to the visualization summary row inside the current transaction.
+#Counters are updated in SQL, so concurrent uploads can't overwrite each other's increments.
+#size_bytes overrides the bytes the upload adds, counted=False adds no file (appends to a dataset).
+def _update_summary(visualization_id: int, new_file: File, db: SQLAlchemy, size_bytes: int | None = None, counted: bool = True):
+    db.session.execute(sqlite_insert(VisualizationSummary).values(
+        visualization_id=visualization_id, data_files_count=0, rscript_files_count=0, total_bytes=0, data_version=0,
+    ).on_conflict_do_nothing())
+    summary = VisualizationSummary
+    values: dict = {
+        summary.total_bytes: summary.total_bytes + ((new_file.size_bytes or 0) if size_bytes is None else size_bytes),
+        summary.last_upload_time: new_file.upload_time,
+    }
+    if isinstance(new_file, DataFile):
+        values[summary.data_files_count] = summary.data_files_count + (1 if counted else 0)
+        if new_file.data_version is not None:
+            values[summary.data_version] = func.max(summary.data_version, new_file.data_version)
+    else:
+        values[summary.rscript_files_count] = summary.rscript_files_count + 1
+    db.session.execute(
+        update(summary).where(summary.visualization_id == visualization_id).values(values),
+        execution_options={"synchronize_session": False},
+    )
+    if isinstance(new_file, DataFile):
+        # A replaced file can cover less than before, so the range is recomputed, never just widened
+        db.session.flush()
+        StorageHandler.refresh_summary_coverage(visualization_id, db)
+
+#Recomputes every summary row from the file tables, used to backfill existing databases
+def rebuild_summaries(db: SQLAlchemy):
+    _backfill_file_metadata(db)
+    db.session.query(VisualizationSummary).delete()
+    files = db.session.query(File).order_by(File.upload_time).all()
+    previous: dict[tuple, File] = {}
+    for f in files:
+        owner = f.data_file or f.r_script_file
+        if owner is None or owner.visualization_id is None:
+            continue
+        before = previous.get((owner.visualization_id, owner.name))
+        previous[(owner.visualization_id, owner.name)] = owner
+        if isinstance(owner, DataFile) and owner.partitioned and isinstance(before, DataFile) and before.partitioned:
+            # Appends share the partitions of the row before, only the difference was written
+            _update_summary(owner.visualization_id, owner, db, size_bytes=(owner.size_bytes or 0) - (before.size_bytes or 0), counted=False) # type: ignore
+        else:
+            _update_summary(owner.visualization_id, owner, db) # type: ignore
+    db.session.commit()
+
+#Files uploaded before sizes and coverage were recorded get them from the stored bytes
+def _backfill_file_metadata(db: SQLAlchemy):
+    for f in db.session.query(File).filter(File.size_bytes == None).all(): # type: ignore
+        if f.compression is not None or not os.path.isfile(f.file_path): # type: ignore
+            continue
+        with open(f.file_path, "rb") as stored: # type: ignore
+            content = stored.read()
+        f.size_bytes = len(content) # type: ignore
+        f.content_hash = f.content_hash or hashlib.sha256(content).hexdigest() # type: ignore
+        data_file = f.data_file
+        if data_file is not None and data_file.coverage_start is None:
+            sample_df, error = _validate_data_file(f.name, content) # type: ignore
+            if not error:
+                column, start, end = _detect_coverage(f.name, content, sample_df) # type: ignore
+                data_file.date_column, data_file.coverage_start, data_file.coverage_end = column, start, end # type: ignore
+    db.session.flush()
+
+#Moves the staged bytes of a new data file to a path of its own, data/<file id>_<name>.
+#Stored files are never overwritten, so committing the row is what makes the upload visible.
+def _place_file(data_file: DataFile, tmp_path: Path, placed: list[str], db: SQLAlchemy):
+    db.session.flush() # assigns the id
+    file_path = get_file_store().path(str(data_file.visualization_id), "data", f"{data_file.id}_{data_file.name}")
+    os.replace(tmp_path, file_path)
+    placed.append(file_path)
+    data_file.file_path = file_path # type: ignore
+
+#Writes content to a hidden temporary file in directory and returns its path
+def _stage_file(directory: Path, filename: str, content: bytes) -> Path:
+    tmp_path = directory / f".{filename}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    return tmp_path
+
+#Bumps the data version of a visualization inside the current transaction.
+#A single UPDATE ... RETURNING, so concurrent uploads always get distinct versions.
+def _next_data_version(visualization_id: int, db: SQLAlchemy) -> int | None:
+    return db.session.execute(
+        update(Visualization)
+        .where(Visualization.id == visualization_id)
+        .values(data_version=func.coalesce(Visualization.data_version, 0) + 1)
+        .returning(Visualization.data_version),
+        execution_options={"synchronize_session": False},
+    ).scalar()
     
 
 def upload_r_script_file(query: FileUploadQuery, db: SQLAlchemy):
@@ -130,8 +564,9 @@ def upload_r_script_file(query: FileUploadQuery, db: SQLAlchemy):
     
     # Save the R script file to diskapp.run(debug=True)
     try:
-        Path(f"./instance/store/{query.visualization_id}/rscripts").mkdir(parents=True, exist_ok=True)
-        file_path = f"./instance/store/{query.visualization_id}/rscripts/{file.filename}"
+        store = get_file_store()
+        store.ensure_dir(str(query.visualization_id), "rscripts")
+        file_path = store.path(str(query.visualization_id), "rscripts", file.filename) # type: ignore
         with open(file_path, "wb") as f:
             f.write(content)
         
@@ -139,9 +574,12 @@ def upload_r_script_file(query: FileUploadQuery, db: SQLAlchemy):
             name=file.filename, # type: ignore
             file_path=file_path,
             visualization_id=query.visualization_id,
+            size_bytes=len(content),
+            content_hash=hashlib.sha256(content).hexdigest(),
         )
         
         db.session.add(new_r_script_file)
+        _update_summary(query.visualization_id, new_r_script_file, db)
         db.session.commit()
     except Exception as e:
         return jsonify({"status": "rejected", "errors": [f"Failed to save R script file: {str(e)}"]}), 500
@@ -161,7 +599,7 @@ def search_data_files(query: FileQuery, db: SQLAlchemy):
             name=f.name, # type: ignore
             file_path=f.file_path, # type: ignore
             upload_time=f.upload_time, # type: ignore
-            download_url=url_for('static', filename=f.file_path, _external=True),
+            download_url=url_for('download_file', id=f.id, _external=True),
             visualization_id=f.visualization_id # type: ignore
         ) # type: ignore
         for f in results
@@ -180,7 +618,7 @@ def search_rscript_files(query: FileQuery, db: SQLAlchemy):
             name=f.name, # type: ignore
             file_path=f.file_path, # type: ignore
             upload_time=f.upload_time, # type: ignore
-            download_url=url_for('static', filename=f.file_path, _external=True),
+            download_url=url_for('download_file', id=f.id, _external=True),
             visualization_id=f.visualization_id # type: ignore
         ) # type: ignore
         for f in results
@@ -188,6 +626,46 @@ def search_rscript_files(query: FileQuery, db: SQLAlchemy):
 
         
 #Returs a list of all files
+#Partitions of the appended datasets of a visualization
+def list_partitions(visualization_id: int, db: SQLAlchemy) -> list[PartitionDTO]:
+    partitions = db.session.query(DataPartition).filter(
+        DataPartition.visualization_id == visualization_id, # type: ignore
+    ).order_by(DataPartition.dataset, DataPartition.month).all()
+    return [
+        PartitionDTO(
+            dataset=p.dataset, # type: ignore
+            month=p.month, # type: ignore
+            rows_count=p.rows_count, # type: ignore
+            size_bytes=p.size_bytes, # type: ignore
+            coverage_start=p.coverage_start, # type: ignore
+            coverage_end=p.coverage_end, # type: ignore
+            data_version=p.data_version, # type: ignore
+            dirty=p.dirty, # type: ignore
+        )
+        for p in partitions
+    ]
+
+"""Marks partitions clean once a downstream consumer has processed them.
+
+Keyword arguments:
+visualization_id -- visualization of the partitions
+data_version -- only partitions changed up to this version are cleaned, None -> all of them
+db -- SQLAlchemy database session
+Return:
+number of partitions marked clean
+"""
+def clean_partitions(visualization_id: int, data_version: int | None, db: SQLAlchemy) -> int:
+    query = db.session.query(DataPartition).filter(
+        DataPartition.visualization_id == visualization_id, # type: ignore
+        DataPartition.dirty == True, # type: ignore
+    )
+    if data_version is not None:
+        query = query.filter(DataPartition.data_version <= data_version) # type: ignore
+    count = query.update({DataPartition.dirty: False}, synchronize_session=False)
+    db.session.commit()
+    return count
+
+
 def list_files(db: SQLAlchemy) -> list[FileDTO]:
     dbQuery = db.session.query(File).all()
     return [
@@ -195,7 +673,102 @@ def list_files(db: SQLAlchemy) -> list[FileDTO]:
             id=f.id,
             name=f.name,
             file_path=f.file_path,
-            upload_time=f.upload_time
+            upload_time=f.upload_time,
+            download_url=url_for('download_file', id=f.id, _external=True),
+            visualization_id=(f.data_file or f.r_script_file).visualization_id if (f.data_file or f.r_script_file) else None
         ) # type: ignore
         for f in dbQuery
-    ]
\ No newline at end of file
+    ]
+
+
+"""Sends a stored data or R script file.
+
+The file is never read into memory: send_file hands it to the server's
+file wrapper (sendfile where available) and handles Range, If-Range and
+If-None-Match against the content hash. With ?compress=gzip (and a client
+accepting gzip) the file is streamed through zlib in chunks instead.
+Appended datasets are streamed from their partitions without Range support,
+only their current version can be downloaded.
+
+Keyword arguments:
+id -- id of the stored file
+db -- SQLAlchemy database session
+Return: 
+Flask response
+"""
+def download_file(id: int, db: SQLAlchemy):
+    f = db.session.get(File, id)
+    wants_gzip = request.args.get("compress") == "gzip" and "gzip" in request.headers.get("Accept-Encoding", "")
+    if f is not None and f.data_file is not None and f.data_file.partitioned:
+        return _download_partitions(f.data_file, wants_gzip, db)
+    if not f or not os.path.isfile(f.file_path): # type: ignore
+        return jsonify({"status": "rejected", "errors": ["File not found"]}), 404
+    path = os.path.abspath(f.file_path) # type: ignore
+
+    # Compacted (compressed) versions can't be sent as is, they are decompressed while streaming
+    if wants_gzip or f.compression:
+        etag = f'"{f.content_hash}-gzip"' if wants_gzip else f'"{f.content_hash}"'
+        if f.content_hash and etag in request.headers.get("If-None-Match", ""):
+            return Response(status=304, headers={"ETag": etag})
+        response = Response(_stream_chunks(f, wants_gzip), mimetype="application/octet-stream", direct_passthrough=True)
+        if wants_gzip:
+            response.headers["Content-Encoding"] = "gzip"
+            response.headers["Vary"] = "Accept-Encoding"
+        response.headers["Content-Disposition"] = f'attachment; filename="{f.name}"'
+        if f.content_hash:
+            response.headers["ETag"] = etag
+        return response
+
+    return send_file(
+        path,
+        as_attachment=True,
+        download_name=f.name, # type: ignore
+        conditional=True,
+        etag=f.content_hash or True, # type: ignore
+    )
+
+def _stream_chunks(f: File, gzip: bool):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if gzip else None # wbits 31 -> gzip container
+    with StorageHandler.open_stored(f) as source:
+        while chunk := source.read(DOWNLOAD_CHUNK_BYTES):
+            data = compressor.compress(chunk) if compressor else chunk
+            if data:
+                yield data
+    if compressor:
+        yield compressor.flush()
+
+#An appended dataset is sent as one CSV, its partitions one after the other
+def _download_partitions(data_file: DataFile, gzip: bool, db: SQLAlchemy):
+    latest_id = db.session.query(func.max(DataFile.id)).filter(
+        DataFile.visualization_id == data_file.visualization_id, # type: ignore
+        DataFile.name == data_file.name, # type: ignore
+    ).scalar()
+    if data_file.id != latest_id:
+        # Appends rewrite the partitions in place, older versions can't be rebuilt
+        return jsonify({"status": "rejected", "errors": ["Older versions of appended datasets are not kept"]}), 404
+    partitions = data_file.partitions
+    digest = hashlib.sha256("".join(p.content_hash or "" for p in partitions).encode()).hexdigest() # type: ignore
+    etag = f'"{digest}-gzip"' if gzip else f'"{digest}"'
+    if etag in request.headers.get("If-None-Match", ""):
+        return Response(status=304, headers={"ETag": etag})
+    response = Response(_stream_partitions([p.file_path for p in partitions], gzip), mimetype="text/csv", direct_passthrough=True) # type: ignore
+    if gzip:
+        response.headers["Content-Encoding"] = "gzip"
+        response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Content-Disposition"] = f'attachment; filename="{data_file.name}"'
+    response.headers["ETag"] = etag
+    response.headers["Accept-Ranges"] = "none" # the length is only known once every partition was read
+    return response
+
+def _stream_partitions(paths: list[str], gzip: bool):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if gzip else None
+    for i, path in enumerate(paths):
+        with open(path, "rb") as source:
+            if i:
+                source.readline() # every partition repeats the header
+            while chunk := source.read(DOWNLOAD_CHUNK_BYTES):
+                data = compressor.compress(chunk) if compressor else chunk
+                if data:
+                    yield data
+    if compressor:
+        yield compressor.flush()
@@ -1,13 +1,20 @@
 from datetime import datetime, timedelta
+import os
 import subprocess
+import threading
+from dataclasses import asdict
 from types import SimpleNamespace
-from typing import List
+from typing import IO, Iterator, List
 
 from flask import json
 from flask_sqlalchemy import SQLAlchemy
-from models.dto_models import ChartDTO, ChartQuery, FileUpdate, VisualizationDTO, chartEntry, DataPoint
-from models.db_models import DataFile, Visualization, RScriptFile
+from sqlalchemy import and_, func, or_
+from models.dto_models import ChartDTO, ChartQuery, FileUpdate, RetentionQuery, VisualizationDTO, VisualizationSummaryDTO, chartEntry, DataPoint
+from models.db_models import DataFile, Visualization, RScriptFile, VisualizationSummary
+from Handlers import ExecutionHandler, ExtractHandler, HistoryHandler
+from backends.factory import get_file_store
 
+RSCRIPT_BIN = os.environ.get("RSCRIPT_BIN", "Rscript") # the load test points this at a stub
 
 STATIC_VALUES = [DataPoint(x=i, y=v) for i, v in [
     [0, 1203],
@@ -74,6 +81,16 @@ STATIC_VALUES2 = [[0, 1503],
  [29, 1462],
  [30, 1781]]
 
+#Raised when a chart query asks for dates the uploaded data does not cover
+class ChartRangeError(ValueError):
+    pass
+
+# Files the forecast window has to lie inside: budget.xlsx gives the expected visitors per day,
+# is_holiday.csv the calendar. Sales history has to exist before the window.
+FORECAST_WINDOW_FILES = ("budget.xlsx", "is_holiday.csv")
+FORECAST_HISTORY_FILE = "sales_location_hourly.csv"
+FORECAST_LOCATION_COLUMN = "locationid"
+
 """Gets chart data for a given chart query.
 
 Keyword arguments:
@@ -83,13 +100,121 @@ Return:
 ChartDTO object containing the chart data
 """
 def get_chart(query: ChartQuery, db: SQLAlchemy) -> ChartDTO | None:
-    # Implementation of the function to fetch and return visualization data
+    visual = _chart_visualization(query, db)
+    if not visual:
+        return None
+    
+    # History charts are plain aggregations of the stored data, no need for R
+    if HistoryHandler.is_history_visualization(visual):
+        return HistoryHandler.get_history_chart(
+            visualization=visual,
+            files=get_data_files_for_range(visual.id, query.start_date, query.end_date, db), # type: ignore
+            start_date=query.start_date,
+            end_date=query.end_date,
+            spread=query.spread,
+        )
+    
+    if not visual.r_script_files:
+        return None
+    
+    # Identical requests share one R run, computed by a worker of any instance
+    try:
+        return ExecutionHandler.run_once(chart_key(visual, query), _chart_job_payload(visual, query))
+    except ExecutionHandler.RScriptError as e:
+        # Failed runs aren't cached, the next request runs the script again
+        print(f"Error executing R script: {e}")
+        return _fallback_chart(visual, query.start_date, query.end_date, query.spread)
+
+
+"""Streams chart data for a given chart query, one series at a time.
+
+The query is checked before anything is streamed, so range errors are still
+raised from here. The events are dicts: a "chart" header, one "series" per
+chartEntry as soon as it is computed, then "end" (or "error" if the
+computation fails after the header was sent).
+
+Keyword arguments:
+query -- ChartQuery object containing the query parameters
+db -- SQLAlchemy database session
+Return:
+iterator over the events, None when there is no chart for the query
+"""
+def stream_chart(query: ChartQuery, db: SQLAlchemy) -> Iterator[dict] | None:
+    visual = _chart_visualization(query, db)
+    if not visual:
+        return None
+    chart = ChartDTO(
+        visualization_id=visual.id, # type: ignore
+        name=visual.name, # type: ignore
+        prediction=visual.prediction, # type: ignore
+        spread=query.spread,
+        start_date=query.start_date,
+        end_date=query.end_date,
+        values=[],
+    )
+    
+    if HistoryHandler.is_history_visualization(visual):
+        entries = HistoryHandler.history_entries(
+            visualization=visual,
+            files=get_data_files_for_range(visual.id, query.start_date, query.end_date, db), # type: ignore
+            start_date=query.start_date,
+            end_date=query.end_date,
+            spread=query.spread,
+        )
+    elif visual.r_script_files:
+        def stream() -> Iterator[chartEntry]:
+            data_dir = _prepare_data_dir(visual, query.start_date, query.end_date, visual.data_version or 0, db) # type: ignore
+            try:
+                yield from rscript_entries(visual, query.start_date, query.end_date, data_dir)
+            except subprocess.CalledProcessError as e:
+                raise ExecutionHandler.RScriptError(str(e)) from e
+        entries = _with_fallback(ExecutionHandler.stream_once(chart_key(visual, query), _chart_job_payload(visual, query), chart, stream))
+    else:
+        return None
+    return _chart_events(chart, entries)
+
+
+#Same fallback as get_chart when the script fails before printing anything, it isn't cached either
+def _with_fallback(entries: Iterator[chartEntry]) -> Iterator[chartEntry]:
+    streamed = False
+    try:
+        for entry in entries:
+            streamed = True
+            yield entry
+    except ExecutionHandler.RScriptError as e:
+        if streamed:
+            raise
+        print(f"Error executing R script: {e}")
+        yield from _fallback_values()
+
+
+def _chart_events(chart: ChartDTO, entries: Iterator[chartEntry]) -> Iterator[dict]:
+    yield {
+        "type": "chart",
+        "visualization_id": chart.visualization_id,
+        "name": chart.name,
+        "prediction": chart.prediction,
+        "spread": chart.spread,
+        "start_date": f"{chart.start_date:%Y-%m-%d}",
+        "end_date": f"{chart.end_date:%Y-%m-%d}",
+    }
+    try:
+        for entry in entries:
+            yield {"type": "series", **asdict(entry)}
+    except Exception as e:
+        yield {"type": "error", "error": str(e)}
+        return
+    yield {"type": "end"}
+
+
+#Loads the queried visualization and checks the query, clipping it to the uploaded data
+def _chart_visualization(query: ChartQuery, db: SQLAlchemy) -> Visualization | None:
     #Gets the Visualization from query id
     visual = db.session.get(Visualization, query.id, options=[
         db.joinedload(Visualization.r_script_files).joinedload(RScriptFile.file)
     ])
     #ID check
-    if not visual or not visual.r_script_files:
+    if not visual:
         return None
     
     if not query.spread:
@@ -98,71 +223,257 @@ def get_chart(query: ChartQuery, db: SQLAlchemy) -> ChartDTO | None:
     if not query.start_date or not query.end_date:
         return None 
     
-    return run_rscript(visualization=visual,start_date=query.start_date,end_date=query.end_date, spread=query.spread)
+    # Reject ranges we have no data for before spawning R
+    if visual.prediction:
+        _check_forecast_range(visual, query, db)
+        return visual
+
+    # History charts only read their source file, partial overlaps are clipped to it
+    if HistoryHandler.is_history_visualization(visual):
+        source_name = HistoryHandler.HISTORY_SOURCES[visual.id].file_name # type: ignore
+        coverage = _current_file_coverage(visual.id, [source_name], db).get(source_name) # type: ignore
+    else:
+        coverage = get_visualization_max_timespan(visual.id, db) # type: ignore
+    if coverage:
+        covered_start, covered_end = coverage
+        if query.end_date < covered_start or query.start_date > covered_end:
+            raise ChartRangeError(f"Requested range is outside of the available data ({covered_start:%Y-%m-%d} to {covered_end:%Y-%m-%d})")
+        query.start_date = max(query.start_date, covered_start)
+        query.end_date = min(query.end_date, covered_end)
+    return visual
+
+#A forecast is not clipped: its window must lie inside the budget and calendar, with sales history before it.
+#Files that are missing or have no detected dates are left to the R script.
+def _check_forecast_range(visual: Visualization, query: ChartQuery, db: SQLAlchemy):
+    coverage = _current_file_coverage(visual.id, [*FORECAST_WINDOW_FILES, FORECAST_HISTORY_FILE], db) # type: ignore
+    for name in FORECAST_WINDOW_FILES:
+        if name not in coverage:
+            continue
+        covered_start, covered_end = coverage[name]
+        if query.start_date < covered_start or query.end_date > covered_end:
+            raise ChartRangeError(f"Requested range is outside of {name} ({covered_start:%Y-%m-%d} to {covered_end:%Y-%m-%d})")
+    if FORECAST_HISTORY_FILE in coverage:
+        history_start, _ = coverage[FORECAST_HISTORY_FILE]
+        if history_start >= query.start_date:
+            raise ChartRangeError(f"{FORECAST_HISTORY_FILE} has no history before {query.start_date:%Y-%m-%d} (it starts {history_start:%Y-%m-%d})")
+
+
+#Everything a chart result depends on: range, spread, data version and the script used
+def chart_key(visual: Visualization, query: ChartQuery) -> str:
+    rscript_id = visual.r_script_files[-1].id if visual.r_script_files else None
+    return f"{visual.id}:{query.start_date:%Y-%m-%d}:{query.end_date:%Y-%m-%d}:{query.spread}:{visual.data_version or 0}:{rscript_id}"
+
+def _chart_job_payload(visual: Visualization, query: ChartQuery) -> dict:
+    return {
+        "id": visual.id,
+        "start_date": query.start_date.isoformat(),
+        "end_date": query.end_date.isoformat(),
+        "spread": query.spread,
+        "data_version": visual.data_version or 0,
+    }
+
+
+"""Computes a queued chart job, called by the chart workers.
+
+Keyword arguments:
+payload -- job payload queued by get_chart
+db -- SQLAlchemy database session
+Return:
+ChartDTO object containing the chart data
+"""
+def compute_chart_job(payload: dict, db: SQLAlchemy) -> ChartDTO | None:
+    visual = db.session.get(Visualization, payload["id"], options=[
+        db.joinedload(Visualization.r_script_files).joinedload(RScriptFile.file)
+    ])
+    if not visual:
+        return None
+    start_date = datetime.fromisoformat(payload["start_date"])
+    end_date = datetime.fromisoformat(payload["end_date"])
+    data_dir = _prepare_data_dir(visual, start_date, end_date, payload["data_version"], db)
+    return run_rscript(visualization=visual, start_date=start_date, end_date=end_date, spread=payload["spread"], data_dir=data_dir)
+
+#R reads the current files from a directory under their uploaded names.
+#Forecasts only need recent history plus the forecast window, R gets just that slice.
+def _prepare_data_dir(visual: Visualization, start_date: datetime, end_date: datetime, data_version: int, db: SQLAlchemy) -> str:
+    if not visual.prediction:
+        return ExtractHandler.prepare_extract(
+            visualization_id=visual.id, # type: ignore
+            data_version=data_version,
+            files=get_current_data_files(visual.id, db), # type: ignore
+            start_date=None,
+            end_date=None,
+        )
+    files = get_current_data_files(visual.id, db) # type: ignore
+    # R builds its date grid and location list from the sales file: the window starts from the
+    # last sales before the forecast, not the forecast start, and every location keeps a row
+    sales = next((f for f in files if f.name == FORECAST_HISTORY_FILE), None)
+    last_sale = ExtractHandler.last_date_before(sales, start_date) if sales is not None else None
+    history_end = last_sale.replace(hour=0, minute=0, second=0, microsecond=0) if last_sale else start_date
+    return ExtractHandler.prepare_extract(
+        visualization_id=visual.id, # type: ignore
+        data_version=data_version,
+        files=files,
+        start_date=history_end - ExtractHandler.HISTORY_WINDOW,
+        end_date=end_date,
+        keep_last={FORECAST_HISTORY_FILE: FORECAST_LOCATION_COLUMN},
+    )
     
 
 
-def run_rscript(visualization: Visualization, start_date: datetime, end_date: datetime, spread: int) -> ChartDTO | None:
+def run_rscript(visualization: Visualization, start_date: datetime, end_date: datetime, spread: int, data_dir: str | None = None) -> ChartDTO | None:
     rscript: RScriptFile = visualization.r_script_files[-1] if visualization.r_script_files else None # type: ignore
     if not rscript:
         return None
-    output = ""
     parsed_values: list[chartEntry] = []
     try:
-        out = subprocess.run(['Rscript', rscript.file.file_path,str(visualization.id),start_date.strftime("%d/%m/%Y"),end_date.strftime("%d/%m/%Y")], capture_output=True, check=True, )
-        if out.returncode != 0:
-            return None
-        output = out.stdout.decode('utf-8')
-        parsed_values = get_values_from_output(output)  
+        parsed_values = list(rscript_entries(visualization, start_date, end_date, data_dir))
     except subprocess.CalledProcessError as e:
-        # Handle errors in R script execution
-            print(f"Error executing R script: {e}")
-            dto = ChartDTO(
+        # Fails the chart job, get_chart answers with _fallback_chart without caching it
+        raise ExecutionHandler.RScriptError(str(e)) from e
+    # Parse the output to create ChartDTO
+    dto = ChartDTO(
         visualization_id=visualization.id, # type: ignore
         name=visualization.name, # type: ignore
         prediction=visualization.prediction, # type: ignore
         spread=spread,
         start_date=start_date,
         end_date=end_date,
-        values= [
-            chartEntry('store1', STATIC_VALUES),
-            chartEntry('store2', STATIC_VALUES)
-        ]
+        values= parsed_values
         )
-            return dto
-    # Parse the output to create ChartDTO
-    dto = ChartDTO(
+    return dto
+
+#Safe chart shown when the R script fails
+def _fallback_chart(visualization: Visualization, start_date: datetime, end_date: datetime, spread: int) -> ChartDTO:
+    return ChartDTO(
         visualization_id=visualization.id, # type: ignore
         name=visualization.name, # type: ignore
         prediction=visualization.prediction, # type: ignore
         spread=spread,
         start_date=start_date,
         end_date=end_date,
-        values= parsed_values
+        values=list(_fallback_values())
         )
-    return dto
+
+def _fallback_values() -> Iterator[chartEntry]:
+    yield chartEntry('store1', STATIC_VALUES)
+    yield chartEntry('store2', STATIC_VALUES)
+
+
+"""Runs the visualization's R script and yields its series while it runs.
+
+The script prints one JSON series per line and flushes after each, every
+line is parsed and yielded as it arrives. Scripts printing a single JSON
+array are still read, in one go.
+
+Keyword arguments:
+visualization -- visualization whose latest R script is run
+start_date -- first day of the chart
+end_date -- last day of the chart
+data_dir -- data directory passed to the script, if any
+Return:
+iterator over the chartEntry objects printed by the script, raises
+CalledProcessError when the script fails and ChartTimeoutError when it is
+killed after RSCRIPT_TIMEOUT_SECONDS
+"""
+def rscript_entries(visualization: Visualization, start_date: datetime, end_date: datetime, data_dir: str | None = None) -> Iterator[chartEntry]:
+    rscript: RScriptFile = visualization.r_script_files[-1] # type: ignore
+    args = [RSCRIPT_BIN, rscript.file.file_path,str(visualization.id),start_date.strftime("%d/%m/%Y"),end_date.strftime("%d/%m/%Y")]
+    if data_dir:
+        args.append(data_dir)
+    with ExecutionHandler.rscript_slot():
+        # R's package messages go to stderr, which nobody reads while we stream.
+        # The scripts find their helpers through FILE_STORE_ROOT.
+        env = {**os.environ, "FILE_STORE_ROOT": os.path.abspath(get_file_store().path())}
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env)
+        timed_out = threading.Event()
+        def kill():
+            timed_out.set()
+            process.kill()
+        timer = threading.Timer(ExecutionHandler.RSCRIPT_TIMEOUT_SECONDS, kill)
+        timer.start()
+        try:
+            yield from _entries_from_lines(process.stdout) # type: ignore
+            process.wait()
+        finally:
+            timer.cancel()
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close() # type: ignore
+    if timed_out.is_set():
+        raise ExecutionHandler.ChartTimeoutError(f"R script did not finish within {ExecutionHandler.RSCRIPT_TIMEOUT_SECONDS:.0f} seconds")
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, args)
+
+def _entries_from_lines(lines: IO[bytes]) -> Iterator[chartEntry]:
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith(b"["):
+            # Older scripts print one (possibly pretty printed) JSON array at the end
+            yield from get_values_from_output((line + lines.read()).decode("utf-8"))
+            return
+        yield _entry_from_json(json.loads(line))
 
 def get_values_from_output(output: str) -> list[chartEntry]:
-    dirty_json = json.loads(output)
-    data: list[chartEntry] = []
-    for entry in dirty_json:
-        name = entry.get("name")
-        values_list = entry.get("values", [])
-        values: list[DataPoint] = []
-        for val in values_list:
-            x = val['x']
-            y = val['y']
-            values.append(DataPoint(x=x, y=y))
-        data.append(chartEntry(name=name, values=values))
-    return data
+    return [_entry_from_json(entry) for entry in json.loads(output)]
+
+def _entry_from_json(entry: dict) -> chartEntry:
+    name = entry.get("name")
+    values_list = entry.get("values", [])
+    values: list[DataPoint] = []
+    for val in values_list:
+        x = val['x']
+        y = val['y']
+        values.append(DataPoint(x=x, y=y))
+    return chartEntry(name=name, values=values) # type: ignore
     
 
 
-def get_visualization_max_timespan(id: int, db: SQLAlchemy):
-    visual = db.session.get(Visualization, id, options=[
-        db.joinedload(Visualization.r_script_files).joinedload(RScriptFile.file)
-    ])
-    # TODO
+#Latest upload of every data file name for a visualization, older uploads with the same name are superseded
+def _current_data_file_ids(v: int, db: SQLAlchemy):
+    return db.session.query(func.max(DataFile.id)).filter(
+        DataFile.visualization_id == v # type: ignore
+    ).group_by(DataFile.name)
+
+#Returns the (start, end) dates covered by the current data files, None when nothing dated is uploaded
+def get_visualization_max_timespan(id: int, db: SQLAlchemy) -> tuple[datetime, datetime] | None:
+    start, end = db.session.query(func.min(DataFile.coverage_start), func.max(DataFile.coverage_end)).filter(
+        DataFile.visualization_id == id, # type: ignore
+        DataFile.id.in_(_current_data_file_ids(id, db)),
+    ).one()
+    if start is None or end is None:
+        return None
+    # Charts are day based, a file starting at 10:00 still covers that day
+    return start.replace(hour=0, minute=0, second=0, microsecond=0), end.replace(hour=0, minute=0, second=0, microsecond=0)
+
+#(start, end) days covered by the current data files with the given names, files without dates are left out
+def _current_file_coverage(v: int, names: list[str], db: SQLAlchemy) -> dict[str, tuple[datetime, datetime]]:
+    rows = db.session.query(DataFile.name, DataFile.coverage_start, DataFile.coverage_end).filter(
+        DataFile.visualization_id == v, # type: ignore
+        DataFile.id.in_(_current_data_file_ids(v, db)),
+        DataFile.name.in_(names),
+    ).all()
+    return {
+        name: (start.replace(hour=0, minute=0, second=0, microsecond=0), end.replace(hour=0, minute=0, second=0, microsecond=0))
+        for name, start, end in rows if start is not None and end is not None
+    }
+
+#Latest upload of every data file of a visualization
+def get_current_data_files(v: int, db: SQLAlchemy) -> List[DataFile]:
+    return db.session.query(DataFile).filter(DataFile.id.in_(_current_data_file_ids(v, db))).all()
+
+#Current data files needed for a date range: files overlapping it plus undated ones (models etc.)
+def get_data_files_for_range(v: int, start_date: datetime, end_date: datetime, db: SQLAlchemy) -> List[DataFile]:
+    return db.session.query(DataFile).filter(
+        DataFile.visualization_id == v, # type: ignore
+        DataFile.id.in_(_current_data_file_ids(v, db)),
+        or_(
+            DataFile.coverage_start.is_(None),
+            and_(DataFile.coverage_start <= end_date, DataFile.coverage_end >= start_date),
+        ),
+    ).all()
 
 def get_last_data_updates(v: int, db: SQLAlchemy) -> List[FileUpdate]:
     one_month_ago = datetime.now() - timedelta(days=30)
@@ -207,6 +518,37 @@ def get_visualizations(db: SQLAlchemy) -> List[VisualizationDTO]:
         results.append(vis_dto)
     return results
 
+#Catalog of all visualizations with file counts, coverage and data version in one query
+def get_visualization_summaries(db: SQLAlchemy) -> List[VisualizationSummaryDTO]:
+    rows = db.session.query(Visualization, VisualizationSummary).outerjoin(
+        VisualizationSummary, VisualizationSummary.visualization_id == Visualization.id
+    ).order_by(Visualization.id).all()
+    results: List[VisualizationSummaryDTO] = []
+    for v, summary in rows:
+        results.append(VisualizationSummaryDTO(
+            id=v.id, # type: ignore
+            name=v.name, # type: ignore
+            is_prediction=v.prediction, # type: ignore
+            data_files_count=summary.data_files_count if summary else 0, # type: ignore
+            rscript_files_count=summary.rscript_files_count if summary else 0, # type: ignore
+            total_bytes=summary.total_bytes if summary else 0, # type: ignore
+            last_upload_time=summary.last_upload_time if summary else None, # type: ignore
+            coverage_start=summary.coverage_start if summary else None, # type: ignore
+            coverage_end=summary.coverage_end if summary else None, # type: ignore
+            data_version=summary.data_version if summary else 0, # type: ignore
+        ))
+    return results
+
+#Sets how many superseded versions of each data file (or how many days of them) storage keeps
+def set_retention(db: SQLAlchemy, id: int, query: RetentionQuery) -> bool:
+    v: Visualization = db.session.get(Visualization, id)
+    if not v:
+        return False
+    v.retention_versions = query.keep_versions # type: ignore
+    v.retention_days = query.keep_days # type: ignore
+    db.session.commit()
+    return True
+
 def get_visualization(db: SQLAlchemy, id: int) -> VisualizationDTO | None:
     v: Visualization = db.session.get(Visualization, id)
     if not v:
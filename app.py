@@ -1,16 +1,17 @@
 from datetime import datetime
-from flask import Flask, json, request, jsonify
+from flask import Flask, Response, json, request, jsonify, stream_with_context
 import pandas as pd
 import io
 from flask_sqlalchemy import SQLAlchemy
-from models.db_models import Base, File, DataFile, RScriptFile, Visualization
-from models.dto_models import ChartQuery, FileQuery, FileUploadQuery
+from models.db_models import Base, File, DataFile, RScriptFile, Visualization, VisualizationSummary
+from models.dto_models import BundleUploadQuery, ChartQuery, FileQuery, FileUploadQuery, RetentionQuery
 from werkzeug.datastructures import FileStorage
 from types import SimpleNamespace
 from db_models_init import db_models_init
+from db_migrate import db_migrate
 from flask_cors import CORS
 
-from Handlers import UploadHandler, VisualizationHandler
+from Handlers import ExecutionHandler, StorageHandler, UploadHandler, VisualizationHandler
 import os
 
 db = SQLAlchemy(model_class=Base)
@@ -23,6 +24,8 @@ CORS(app, resources={r"/api/*": {"origins": "*"}})
 db.init_app(app)
 with app.app_context():
     db.create_all()
+    # Databases from older versions get the newer columns before anything queries them
+    db_migrate(db)
     db_models_init(db)
     if db.session.query(RScriptFile).count() == 0:
         with open("helper_forecast.R", "rb") as f: # !!! Im keeping it hardcoded 
@@ -35,6 +38,10 @@ with app.app_context():
                 file=FileStorage(f),
                 visualization_id=3, 
             ))
+    if db.session.query(VisualizationSummary).count() == 0:
+        UploadHandler.rebuild_summaries(db)
+StorageHandler.start_compaction_thread(app, db)
+ExecutionHandler.start_workers(app, lambda payload: VisualizationHandler.compute_chart_job(payload, db=db))
     
 @app.route('/')
 def hello_world():
@@ -49,14 +56,37 @@ def file_validation():
     if 'visualization_id' not in request.form:
         return jsonify({"status": "rejected", "errors": ["No visualization_id provided in 'visualization_id' field."]}), 400
     try: 
+        key_columns = request.form.get("key_columns")
         query: FileUploadQuery = FileUploadQuery(
             file=request.files['file'],
-            visualization_id=int(request.form.get("visualization_id", type=int)) # type: ignore
+            visualization_id=int(request.form.get("visualization_id", type=int)), # type: ignore
+            mode=request.form.get("mode", "replace"),
+            key_columns=[c.strip() for c in key_columns.split(",") if c.strip()] if key_columns else None,
         )
+        if query.mode not in ("replace", "append"):
+            raise ValueError(f"Unknown mode: {query.mode}")
     except Exception as e:
         return jsonify({"status": "rejected", "errors": [f"Invalid input data: {str(e)}"]}), 400
+    if query.mode == "append":
+        return UploadHandler.append_data_file(query=query, db=db)
     return UploadHandler.upload_data_file(query=query, db=db)
 
+@app.route("/api/upload/bundle", methods=["POST"])
+#Uploads several data files (or one .zip) as a single data version
+def upload_bundle():
+    if 'files' not in request.files:
+        return jsonify({"status": "rejected", "errors": ["No files provided in 'files' field."]}), 400
+    if 'visualization_id' not in request.form:
+        return jsonify({"status": "rejected", "errors": ["No visualization_id provided in 'visualization_id' field."]}), 400
+    try: 
+        query: BundleUploadQuery = BundleUploadQuery(
+            files=request.files.getlist('files'),
+            visualization_id=int(request.form.get("visualization_id", type=int)) # type: ignore
+        )
+    except Exception as e:
+        return jsonify({"status": "rejected", "errors": [f"Invalid input data: {str(e)}"]}), 400
+    return UploadHandler.upload_data_bundle(query=query, db=db)
+
 @app.route("/api/upload/rscript", methods=["POST"]) # type: ignore
 def upload_rscript():
     if 'file' not in request.files:
@@ -101,15 +131,69 @@ def get_last_data_by_visualization(visualization_id: int):
 def list_files():
     return jsonify(UploadHandler.list_files(db=db))
 
+@app.route("/api/files/<int:id>/download", methods=["GET"])
+def download_file(id: int):
+    return UploadHandler.download_file(id=id, db=db)
+
 @app.route("/api/visualizations", methods=["GET"])
 def get_visualizations():
     return jsonify(VisualizationHandler.get_visualizations(db=db))
 
 
+@app.route("/api/visualizations/summary", methods=["GET"])
+def get_visualization_summaries():
+    return jsonify(VisualizationHandler.get_visualization_summaries(db=db))
+
 @app.route("/api/visualization/<id>", methods=["GET"])
 def get_visualization_byId(id: int):
     return jsonify(VisualizationHandler.get_visualization(db=db, id=id)) # type: ignore
 
+@app.route("/api/visualization/<id>/timespan", methods=["GET"])
+def get_visualization_timespan(id: int):
+    timespan = VisualizationHandler.get_visualization_max_timespan(id=id, db=db) # type: ignore
+    if not timespan:
+        return jsonify({"start_date": None, "end_date": None})
+    return jsonify({"start_date": timespan[0].strftime("%Y-%m-%d"), "end_date": timespan[1].strftime("%Y-%m-%d")})
+
+@app.route("/api/visualization/<id>/retention", methods=["PUT"])
+def set_visualization_retention(id: int):
+    try:
+        body = json.loads(request.data)
+        query: RetentionQuery = RetentionQuery(
+            keep_versions=int(body["keep_versions"]) if body.get("keep_versions") is not None else None,
+            keep_days=int(body["keep_days"]) if body.get("keep_days") is not None else None,
+        )
+    except Exception as e:
+        return jsonify({"status": "rejected", "errors": [f"Invalid input data: {str(e)}"]}), 400
+    negative = [name for name in ("keep_versions", "keep_days") if (getattr(query, name) or 0) < 0]
+    if negative:
+        return jsonify({"status": "rejected", "errors": [f"{name} must not be negative" for name in negative]}), 400
+    if not VisualizationHandler.set_retention(db=db, id=id, query=query):
+        return jsonify({"status": "rejected", "errors": ["Visualization not found"]}), 404
+    return jsonify({"status": "ok", "message": "Retention updated"}), 200
+
+@app.route("/api/visualization/<int:id>/partitions", methods=["GET"])
+def get_visualization_partitions(id: int):
+    return jsonify(UploadHandler.list_partitions(visualization_id=id, db=db))
+
+#Downstream consumers acknowledge the partitions they processed, up to an optional data_version
+@app.route("/api/visualization/<int:id>/partitions/clean", methods=["POST"])
+def clean_visualization_partitions(id: int):
+    try:
+        body = json.loads(request.data) if request.data else {}
+        data_version = int(body["data_version"]) if body.get("data_version") is not None else None
+    except Exception as e:
+        return jsonify({"status": "rejected", "errors": [f"Invalid input data: {str(e)}"]}), 400
+    cleaned = UploadHandler.clean_partitions(visualization_id=id, data_version=data_version, db=db)
+    return jsonify({"status": "ok", "cleaned": cleaned}), 200
+
+@app.route("/api/storage/compact", methods=["POST"])
+def compact_storage():
+    stats = StorageHandler.try_compact_storage(db=db)
+    if stats is None:
+        return jsonify({"status": "rejected", "errors": ["Storage compaction is already running"]}), 409
+    return jsonify(stats)
+
 @app.route("/api/visualizations/chart", methods=["POST"])
 def get_chart():
     try:
@@ -118,7 +202,34 @@ def get_chart():
         query.end_date = datetime.strptime(query.end_date, "%Y-%m-%d") # type: ignore
     except Exception as e:
         return jsonify({"status": "rejected", "errors": [f"Invalid input data: {str(e)}"]}), 400
-    return  jsonify(VisualizationHandler.get_chart(query=query, db=db))
+    try:
+        chart = VisualizationHandler.get_chart(query=query, db=db)
+    except VisualizationHandler.ChartRangeError as e:
+        return jsonify({"status": "rejected", "errors": [str(e)]}), 400
+    except ExecutionHandler.ChartBusyError as e:
+        return jsonify({"status": "rejected", "errors": [str(e)]}), 503
+    except ExecutionHandler.ChartTimeoutError as e:
+        return jsonify({"status": "rejected", "errors": [str(e)]}), 504
+    except ExecutionHandler.ChartJobError as e:
+        return jsonify({"status": "rejected", "errors": [str(e)]}), 500
+    return  jsonify(chart)
+
+#Same query as /api/visualizations/chart, answered as NDJSON with one line per series as soon as it is computed
+@app.route("/api/visualizations/chart/stream", methods=["POST"])
+def stream_chart():
+    try:
+        query: ChartQuery = json.loads(request.data, object_hook=lambda d: SimpleNamespace(**d))
+        query.start_date = datetime.strptime(query.start_date, "%Y-%m-%d") # type: ignore
+        query.end_date = datetime.strptime(query.end_date, "%Y-%m-%d") # type: ignore
+    except Exception as e:
+        return jsonify({"status": "rejected", "errors": [f"Invalid input data: {str(e)}"]}), 400
+    try:
+        events = VisualizationHandler.stream_chart(query=query, db=db)
+    except VisualizationHandler.ChartRangeError as e:
+        return jsonify({"status": "rejected", "errors": [str(e)]}), 400
+    if events is None:
+        return jsonify(None)
+    return Response(stream_with_context(json.dumps(event) + "\n" for event in events), mimetype="application/x-ndjson")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,80 @@
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass
+class Job:
+    id: int
+    key: str
+    payload: dict
+    status: str  # queued, running, done or failed
+    error_kind: Optional[str] = None
+    error: Optional[str] = None
+
+
+#Work shared by every app instance, a key is queued at most once at a time
+class JobQueue(ABC):
+    @abstractmethod
+    def enqueue(self, key: str, payload: dict) -> None:
+        """Queues a job for key unless one is already queued or running."""
+
+    @abstractmethod
+    def claim(self, worker_id: str) -> Optional[Job]:
+        """Marks the oldest queued job as running for worker_id and returns it."""
+
+    @abstractmethod
+    def start(self, key: str, payload: dict, worker_id: str) -> Optional[Job]:
+        """Queues a job for key already running on worker_id, None when key is queued or running elsewhere."""
+
+    @abstractmethod
+    def complete(self, job_id: int) -> None:
+        pass
+
+    @abstractmethod
+    def fail(self, job_id: int, kind: str, error: str) -> None:
+        pass
+
+    @abstractmethod
+    def release(self, job_id: int) -> None:
+        """Puts a running job back in the queue for any worker to pick up."""
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[Job]:
+        pass
+
+    @abstractmethod
+    def pending_count(self) -> int:
+        """Number of queued and running jobs."""
+
+    @abstractmethod
+    def purge(self, older_than_seconds: float) -> None:
+        """Drops finished jobs that were last updated longer ago than older_than_seconds."""
+
+
+#Serialized results readable by every app instance
+class ResultCache(ABC):
+    @abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        pass
+
+    @abstractmethod
+    def set(self, key: str, value: str, ttl_seconds: float) -> None:
+        pass
+
+    @abstractmethod
+    def purge(self) -> None:
+        """Drops expired entries."""
+
+
+#Where uploaded files live, paths returned are what R and send_file read from.
+#Files are read and written by path, so every instance (and R, which gets
+#FILE_STORE_ROOT) must see the store as a filesystem: local disk or a shared mount.
+class FileStore(ABC):
+    @abstractmethod
+    def path(self, *parts: str) -> str:
+        """Path of a stored file (or directory) below the store root."""
+
+    @abstractmethod
+    def ensure_dir(self, *parts: str) -> str:
+        """Creates a directory below the store root and returns its path."""
@@ -0,0 +1,47 @@
+import os
+import threading
+from typing import Callable
+
+from backends.base import FileStore, JobQueue, ResultCache
+from backends.local import LocalFileStore, SQLiteJobQueue, SQLiteResultCache, _SQLiteDatabase
+
+# BACKEND picks the implementation, "local" works for any number of processes on one host
+BACKEND = os.environ.get("BACKEND", "local")
+BACKEND_DB_PATH = os.environ.get("BACKEND_DB_PATH", "./instance/backend.db")
+FILE_STORE_ROOT = os.environ.get("FILE_STORE_ROOT", "./instance/store")
+JOB_LEASE_SECONDS = float(os.environ.get("JOB_LEASE_SECONDS", 600))
+
+
+def _local_backend() -> tuple[JobQueue, ResultCache, FileStore]:
+    database = _SQLiteDatabase(BACKEND_DB_PATH)
+    return SQLiteJobQueue(database, JOB_LEASE_SECONDS), SQLiteResultCache(database), LocalFileStore(FILE_STORE_ROOT)
+
+BACKENDS: dict[str, Callable[[], tuple[JobQueue, ResultCache, FileStore]]] = {
+    "local": _local_backend,
+}
+
+_backend: tuple[JobQueue, ResultCache, FileStore] | None = None
+_backend_lock = threading.Lock()
+
+
+#Makes another implementation selectable with BACKEND=<name>
+def register_backend(name: str, factory: Callable[[], tuple[JobQueue, ResultCache, FileStore]]):
+    BACKENDS[name] = factory
+
+def _get() -> tuple[JobQueue, ResultCache, FileStore]:
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if BACKEND not in BACKENDS:
+                raise RuntimeError(f"Unknown backend: {BACKEND}")
+            _backend = BACKENDS[BACKEND]()
+        return _backend
+
+def get_job_queue() -> JobQueue:
+    return _get()[0]
+
+def get_result_cache() -> ResultCache:
+    return _get()[1]
+
+def get_file_store() -> FileStore:
+    return _get()[2]
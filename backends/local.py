@@ -0,0 +1,164 @@
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from backends.base import FileStore, Job, JobQueue, ResultCache
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL UNIQUE,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    worker TEXT,
+    error_kind TEXT,
+    error TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_jobs_status ON jobs (status, id);
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+
+#One SQLite file in WAL mode shared by every process on the host, one connection per thread
+class _SQLiteDatabase:
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.connection().executescript(SCHEMA)
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+
+class SQLiteJobQueue(JobQueue):
+    def __init__(self, database: _SQLiteDatabase, lease_seconds: float):
+        self.database = database
+        self.lease_seconds = lease_seconds # running jobs not updated for this long are given to another worker
+
+    def enqueue(self, key: str, payload: dict) -> None:
+        self.database.connection().execute(
+            """INSERT INTO jobs (key, payload, status, updated_at) VALUES (?, ?, 'queued', ?)
+               ON CONFLICT(key) DO UPDATE SET payload = excluded.payload, status = 'queued', worker = NULL,
+                   error_kind = NULL, error = NULL, updated_at = excluded.updated_at
+               WHERE jobs.status IN ('done', 'failed')""",
+            (key, json.dumps(payload), time.time()),
+        )
+
+    def claim(self, worker_id: str) -> Optional[Job]:
+        conn = self.database.connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                """SELECT id, key, payload FROM jobs
+                   WHERE status = 'queued' OR (status = 'running' AND updated_at < ?)
+                   ORDER BY id LIMIT 1""",
+                (now - self.lease_seconds,),
+            ).fetchone()
+            if row is not None:
+                conn.execute("UPDATE jobs SET status = 'running', worker = ?, updated_at = ? WHERE id = ?", (worker_id, now, row[0]))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        return Job(id=row[0], key=row[1], payload=json.loads(row[2]), status="running")
+
+    def start(self, key: str, payload: dict, worker_id: str) -> Optional[Job]:
+        conn = self.database.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            changed = conn.execute(
+                """INSERT INTO jobs (key, payload, status, worker, updated_at) VALUES (?, ?, 'running', ?, ?)
+                   ON CONFLICT(key) DO UPDATE SET payload = excluded.payload, status = 'running', worker = excluded.worker,
+                       error_kind = NULL, error = NULL, updated_at = excluded.updated_at
+                   WHERE jobs.status IN ('done', 'failed')""",
+                (key, json.dumps(payload), worker_id, time.time()),
+            ).rowcount
+            row = conn.execute("SELECT id FROM jobs WHERE key = ?", (key,)).fetchone() if changed else None
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        return Job(id=row[0], key=key, payload=payload, status="running")
+
+    def complete(self, job_id: int) -> None:
+        self.database.connection().execute("UPDATE jobs SET status = 'done', updated_at = ? WHERE id = ?", (time.time(), job_id))
+
+    def fail(self, job_id: int, kind: str, error: str) -> None:
+        self.database.connection().execute(
+            "UPDATE jobs SET status = 'failed', error_kind = ?, error = ?, updated_at = ? WHERE id = ?",
+            (kind, error, time.time(), job_id),
+        )
+
+    def release(self, job_id: int) -> None:
+        self.database.connection().execute(
+            "UPDATE jobs SET status = 'queued', worker = NULL, updated_at = ? WHERE id = ? AND status = 'running'",
+            (time.time(), job_id),
+        )
+
+    def get(self, key: str) -> Optional[Job]:
+        row = self.database.connection().execute(
+            "SELECT id, key, payload, status, error_kind, error FROM jobs WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        return Job(id=row[0], key=row[1], payload=json.loads(row[2]), status=row[3], error_kind=row[4], error=row[5])
+
+    def pending_count(self) -> int:
+        return self.database.connection().execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')").fetchone()[0]
+
+    def purge(self, older_than_seconds: float) -> None:
+        self.database.connection().execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?", (time.time() - older_than_seconds,)
+        )
+
+
+class SQLiteResultCache(ResultCache):
+    def __init__(self, database: _SQLiteDatabase):
+        self.database = database
+
+    def get(self, key: str) -> Optional[str]:
+        row = self.database.connection().execute(
+            "SELECT value FROM results WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str, ttl_seconds: float) -> None:
+        self.database.connection().execute(
+            "INSERT OR REPLACE INTO results (key, value, expires_at) VALUES (?, ?, ?)", (key, value, time.time() + ttl_seconds)
+        )
+
+    def purge(self) -> None:
+        self.database.connection().execute("DELETE FROM results WHERE expires_at <= ?", (time.time(),))
+
+
+class LocalFileStore(FileStore):
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, *parts: str) -> str:
+        return "/".join([self.root.rstrip("/"), *(str(p) for p in parts)])
+
+    def ensure_dir(self, *parts: str) -> str:
+        path = self.path(*parts)
+        Path(path).mkdir(parents=True, exist_ok=True)
+        return path
@@ -0,0 +1,40 @@
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import text
+
+from models.db_models import Base
+
+
+"""Adds columns and indexes the models gained since a database was created.
+
+db.create_all() only creates missing tables, so databases created by an
+older version of the app lack newer columns. Missing columns are added with
+ALTER TABLE, using the column's scalar default as the SQL default so NOT
+NULL columns can be added to tables that already have rows. Safe to run on
+every startup.
+
+Keyword arguments:
+db -- SQLAlchemy database session
+Return:
+list of "table.column" names that were added
+"""
+def db_migrate(db: SQLAlchemy) -> list[str]:
+    added = []
+    with db.engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {row[1] for row in conn.execute(text(f'PRAGMA table_info("{table.name}")'))}
+            if not existing:
+                continue # table doesn't exist yet, create_all makes it
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column.type.compile(dialect=conn.dialect)}'
+                default = column.default.arg if column.default is not None and column.default.is_scalar else None
+                if default is not None:
+                    ddl += f" DEFAULT {int(default) if isinstance(default, bool) else repr(default)}"
+                if not column.nullable and default is not None:
+                    ddl += " NOT NULL"
+                conn.execute(text(ddl))
+                added.append(f"{table.name}.{column.name}")
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+    return added
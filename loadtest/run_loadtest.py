@@ -0,0 +1,204 @@
+# Concurrent end-to-end load test for a running backend instance.
+#
+# Start the backend with the stub R script so chart requests have a known cost:
+#   RSCRIPT_BIN=loadtest/bin/Rscript STUB_RSCRIPT_LATENCY=2 python app.py
+# Then drive it:
+#   python loadtest/run_loadtest.py --base-url http://localhost:5000 --concurrency 32 --ramp-up 10 --duration 60 --output report.json
+#
+# The report is JSON: latency percentiles (ms), error rate and throughput per route and overall.
+import argparse
+import io
+import json
+import math
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import date, timedelta
+
+import requests
+
+# Relative weight of every route in the traffic mix
+DEFAULT_MIX = "upload=1,search=4,visualizations=6,chart=3"
+
+
+@dataclass
+class Sample:
+    route: str
+    status: int  # 0 when the request itself failed (connection error, timeout)
+    latency: float  # seconds
+    ok: bool
+
+
+def upload(session: requests.Session, args) -> requests.Response:
+    rows = "\n".join(
+        f"{date(2024, 1, 1) + timedelta(hours=i):%Y-%m-%d} {i % 24:02d}:00:00,{1 + i % 3},{random.uniform(10, 500):.2f}"
+        for i in range(args.upload_rows)
+    )
+    content = f"Date,locationid,total\n{rows}\n".encode()
+    return session.post(
+        f"{args.base_url}/api/upload/data",
+        data={"visualization_id": str(args.upload_visualization_id)},
+        files={"file": ("loadtest_sales.csv", io.BytesIO(content))},
+        timeout=args.timeout,
+    )
+
+def search(session: requests.Session, args) -> requests.Response:
+    return session.post(
+        f"{args.base_url}/api/data/search",
+        data=json.dumps({"visualization_id": random.choice(args.visualization_ids)}),
+        timeout=args.timeout,
+    )
+
+def visualizations(session: requests.Session, args) -> requests.Response:
+    return session.get(f"{args.base_url}/api/visualizations", timeout=args.timeout)
+
+def chart(session: requests.Session, args) -> requests.Response:
+    # A small set of distinct ranges, like many users opening the same dashboards
+    offset = random.randrange(args.distinct_charts)
+    start = date.fromisoformat(args.chart_start) + timedelta(days=offset)
+    return session.post(
+        f"{args.base_url}/api/visualizations/chart",
+        data=json.dumps({
+            "id": args.chart_visualization_id,
+            "start_date": start.isoformat(),
+            "end_date": (start + timedelta(days=args.chart_days - 1)).isoformat(),
+            "spread": 1,
+        }),
+        timeout=args.timeout,
+    )
+
+ROUTES = {
+    "upload": upload,
+    "search": search,
+    "visualizations": visualizations,
+    "chart": chart,
+}
+
+
+def parse_mix(mix: str) -> tuple[list[str], list[float]]:
+    names, weights = [], []
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in ROUTES:
+            raise ValueError(f"Unknown route in mix: {name}")
+        names.append(name)
+        weights.append(float(weight or 1))
+    return names, weights
+
+
+def worker(args, names: list[str], weights: list[float], stop_at: float, samples: list[Sample], lock: threading.Lock):
+    session = requests.Session()
+    local: list[Sample] = []
+    while time.monotonic() < stop_at:
+        route = random.choices(names, weights)[0]
+        started = time.perf_counter()
+        try:
+            response = ROUTES[route](session, args)
+            status, ok = response.status_code, response.status_code < 400
+        except requests.RequestException:
+            status, ok = 0, False
+        local.append(Sample(route, status, time.perf_counter() - started, ok))
+        if args.think_time:
+            time.sleep(random.uniform(0, 2 * args.think_time))
+    with lock:
+        samples.extend(local)
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    # nearest-rank percentile
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(q / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+def summarize(samples: list[Sample], elapsed: float) -> dict:
+    latencies = sorted(s.latency * 1000 for s in samples)
+    errors = sum(1 for s in samples if not s.ok)
+    statuses: dict[str, int] = defaultdict(int)
+    for s in samples:
+        statuses[str(s.status)] += 1
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "error_rate": round(errors / len(samples), 4) if samples else 0.0,
+        "throughput_rps": round(len(samples) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50), 2),
+            "p95": round(percentile(latencies, 95), 2),
+            "p99": round(percentile(latencies, 99), 2),
+            "max": round(latencies[-1], 2) if latencies else 0.0,
+            "mean": round(sum(latencies) / len(latencies), 2) if latencies else 0.0,
+        },
+        "status_codes": dict(statuses),
+    }
+
+
+def run(args) -> dict:
+    names, weights = parse_mix(args.mix)
+    samples: list[Sample] = []
+    lock = threading.Lock()
+    started = time.monotonic()
+    stop_at = started + args.ramp_up + args.duration
+    threads = []
+    for i in range(args.concurrency):
+        # Workers are started evenly over the ramp-up period
+        if args.ramp_up and i:
+            time.sleep(args.ramp_up / args.concurrency)
+        t = threading.Thread(target=worker, args=(args, names, weights, stop_at, samples, lock), daemon=True)
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - started
+
+    by_route: dict[str, list[Sample]] = defaultdict(list)
+    for s in samples:
+        by_route[s.route].append(s)
+    return {
+        "config": {
+            "base_url": args.base_url,
+            "concurrency": args.concurrency,
+            "ramp_up_seconds": args.ramp_up,
+            "duration_seconds": args.duration,
+            "mix": dict(zip(names, weights)),
+        },
+        "elapsed_seconds": round(elapsed, 2),
+        "overall": summarize(samples, elapsed),
+        "routes": {route: summarize(route_samples, elapsed) for route, route_samples in sorted(by_route.items())},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Concurrent load test for the visualization backend")
+    parser.add_argument("--base-url", default="http://localhost:5000")
+    parser.add_argument("--concurrency", type=int, default=16, help="number of concurrent virtual users")
+    parser.add_argument("--ramp-up", type=float, default=5, help="seconds over which users are started")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of full load after ramp-up")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"route weights, default {DEFAULT_MIX}")
+    parser.add_argument("--think-time", type=float, default=0.0, help="mean pause between requests of one user")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--visualization-ids", type=int, nargs="+", default=[1, 2, 3])
+    parser.add_argument("--upload-visualization-id", type=int, default=1)
+    parser.add_argument("--upload-rows", type=int, default=500)
+    parser.add_argument("--chart-visualization-id", type=int, default=3)
+    parser.add_argument("--chart-start", default="2024-07-01")
+    parser.add_argument("--chart-days", type=int, default=14)
+    parser.add_argument("--distinct-charts", type=int, default=4, help="how many different chart ranges are requested")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+    args.base_url = args.base_url.rstrip("/")
+
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
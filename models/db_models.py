@@ -1,6 +1,6 @@
 from datetime import datetime
 from sqlalchemy import (
-    Column, Integer, String, DateTime, Boolean, ForeignKey, Interval
+    Column, Integer, BigInteger, String, DateTime, Boolean, ForeignKey, Interval, Index
 )
 from sqlalchemy.orm import relationship, declarative_base
 
@@ -12,15 +12,20 @@ class File(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String, nullable=False)
     file_path = Column(String, nullable=False)
-    upload_time = Column(DateTime, default=datetime.utcnow)
+    upload_time = Column(DateTime, default=datetime.utcnow, index=True)
+    size_bytes = Column(BigInteger, nullable=True)
+    content_hash = Column(String, nullable=True) # sha256 of the stored bytes, used as ETag
+    compression = Column(String, nullable=True) # None, "gzip" or "zstd" once superseded and compacted
     
     # Relationships
     data_file = relationship('DataFile', back_populates='file', uselist=False)
     r_script_file = relationship('RScriptFile', back_populates='file', uselist=False)
     
-    def __init__(self, name: str, file_path: str):
+    def __init__(self, name: str, file_path: str, size_bytes: int | None = None, content_hash: str | None = None):
         self.name = name
         self.file_path = file_path
+        self.size_bytes = size_bytes
+        self.content_hash = content_hash
         self.upload_time = datetime.now()
 
 
@@ -31,10 +36,14 @@ class Visualization(Base):
     name = Column(String, nullable=False)
     description = Column(String)
     prediction = Column(Boolean, default=False)
+    data_version = Column(Integer, nullable=False, default=0) # bumped once per committed upload
+    retention_versions = Column(Integer, nullable=True) # superseded versions kept per file, None -> DEFAULT_KEEP_VERSIONS
+    retention_days = Column(Integer, nullable=True) # superseded versions older than this are dropped, None -> no age limit
 
     # Relationships
     data_files = relationship('DataFile', back_populates='visualization')
     r_script_files = relationship('RScriptFile', back_populates='visualization')
+    summary = relationship('VisualizationSummary', back_populates='visualization', uselist=False)
     
     def __init__(self, name: str, description: str, prediction: bool = False):
         self.name = name
@@ -44,36 +53,113 @@ class Visualization(Base):
 
 class DataFile(File):
     __tablename__ = 'data_files'
+    __table_args__ = (
+        # Interval lookups: which files of a visualization overlap a date range
+        Index('ix_data_files_coverage', 'visualization_id', 'coverage_start', 'coverage_end'),
+    )
 
     id = Column(Integer, ForeignKey('files.id'), primary_key=True)
     timespan = Column(Interval, nullable=True)
     rows_count = Column(Integer, nullable=False)
     extension = Column(String, nullable=False)
+    data_version = Column(Integer, nullable=True)
+    coverage_start = Column(DateTime, nullable=True) # first date found in the file
+    coverage_end = Column(DateTime, nullable=True) # last date found in the file
+    date_column = Column(String, nullable=True) # column the coverage was read from
+    partitioned = Column(Boolean, nullable=True, default=False) # appended dataset, file_path is the partitions directory
     visualization_id = Column(Integer, ForeignKey('visualizations.id'))
 
     # Relationships
     visualization = relationship('Visualization', back_populates='data_files')
     file = relationship('File', back_populates='data_file')
+    partitions = relationship(
+        'DataPartition',
+        primaryjoin="and_(DataFile.visualization_id == foreign(DataPartition.visualization_id), File.name == foreign(DataPartition.dataset))",
+        order_by='DataPartition.month',
+        viewonly=True,
+    )
     
-    def __init__(self, name: str, file_path: str, rows_count: int, extension: str, visualization_id: int, timespan: datetime | None = None):
-        super().__init__(name, file_path)
+    def __init__(self, name: str, file_path: str, rows_count: int, extension: str, visualization_id: int, timespan: datetime | None = None, data_version: int | None = None,
+                 size_bytes: int | None = None, coverage_start: datetime | None = None, coverage_end: datetime | None = None, date_column: str | None = None,
+                 content_hash: str | None = None):
+        super().__init__(name, file_path, size_bytes, content_hash)
         self.rows_count = rows_count
         self.extension = extension
         self.visualization_id = visualization_id
         self.timespan = timespan
+        self.data_version = data_version
+        self.coverage_start = coverage_start
+        self.coverage_end = coverage_end
+        self.date_column = date_column
+        self.partitioned = False
+
+
+# One month of an appended dataset. Appends rewrite only the months they touch,
+# those are flagged dirty until downstream consumers mark them clean.
+class DataPartition(Base):
+    __tablename__ = 'data_partitions'
+    __table_args__ = (
+        Index('ix_data_partitions_month', 'visualization_id', 'dataset', 'month', unique=True),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    visualization_id = Column(Integer, ForeignKey('visualizations.id'), nullable=False)
+    dataset = Column(String, nullable=False) # name of the data file the rows belong to
+    month = Column(String, nullable=False) # YYYY-MM
+    file_path = Column(String, nullable=False)
+    rows_count = Column(Integer, nullable=False, default=0)
+    size_bytes = Column(BigInteger, nullable=False, default=0)
+    content_hash = Column(String, nullable=True)
+    coverage_start = Column(DateTime, nullable=True)
+    coverage_end = Column(DateTime, nullable=True)
+    data_version = Column(Integer, nullable=False, default=0) # version of the last change
+    dirty = Column(Boolean, nullable=False, default=True)
+    updated_time = Column(DateTime, default=datetime.utcnow)
+
+    def __init__(self, visualization_id: int, dataset: str, month: str):
+        self.visualization_id = visualization_id
+        self.dataset = dataset
+        self.month = month
+        self.rows_count = 0
+        self.size_bytes = 0
+        self.dirty = True
 
 
 class RScriptFile(File):
     __tablename__ = 'r_script_files'
 
     id = Column(Integer, ForeignKey('files.id'), primary_key=True)
-    visualization_id = Column(Integer, ForeignKey('visualizations.id'))
+    visualization_id = Column(Integer, ForeignKey('visualizations.id'), index=True)
 
     # Relationships
     visualization = relationship('Visualization', back_populates='r_script_files')
     file = relationship('File', back_populates='r_script_file')
     
-    def __init__(self, name: str, file_path: str, visualization_id: int):
-        super().__init__(name, file_path)
+    def __init__(self, name: str, file_path: str, visualization_id: int, size_bytes: int | None = None, content_hash: str | None = None):
+        super().__init__(name, file_path, size_bytes, content_hash)
+        self.visualization_id = visualization_id
+
+
+# One row per visualization, kept up to date in the same transaction as every upload
+# so the catalog page can be served from a single primary key join.
+class VisualizationSummary(Base):
+    __tablename__ = 'visualization_summaries'
+
+    visualization_id = Column(Integer, ForeignKey('visualizations.id'), primary_key=True)
+    data_files_count = Column(Integer, nullable=False, default=0)
+    rscript_files_count = Column(Integer, nullable=False, default=0)
+    total_bytes = Column(BigInteger, nullable=False, default=0)
+    last_upload_time = Column(DateTime, nullable=True)
+    coverage_start = Column(DateTime, nullable=True)
+    coverage_end = Column(DateTime, nullable=True)
+    data_version = Column(Integer, nullable=False, default=0)
+
+    # Relationships
+    visualization = relationship('Visualization', back_populates='summary')
+
+    def __init__(self, visualization_id: int):
         self.visualization_id = visualization_id
-        
\ No newline at end of file
+        self.data_files_count = 0
+        self.rscript_files_count = 0
+        self.total_bytes = 0
+        self.data_version = 0
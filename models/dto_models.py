@@ -45,6 +45,12 @@ class ChartQuery:
     spread: int
 
 
+@dataclass
+class RetentionQuery:
+    keep_versions: Optional[int]  # superseded versions kept per data file
+    keep_days: Optional[int]  # superseded versions older than this are dropped
+
+
 @dataclass
 class FileQuery:
     visualization_id: int
@@ -57,6 +63,13 @@ class FileQuery:
 class FileUploadQuery:
     file: FileStorage
     visualization_id: int
+    mode: str = "replace"  # "append" merges the rows into the dataset's monthly partitions
+    key_columns: Optional[List[str]] = None  # identify a row when appending, None -> every column
+
+@dataclass
+class BundleUploadQuery:
+    files: List[FileStorage]  # either several data files or a single .zip archive
+    visualization_id: int
 
 @dataclass
 class FileDTO:
@@ -74,5 +87,26 @@ class FilePage:
     query: FileQuery
     files: List[FileDTO]
 
+@dataclass
+class VisualizationSummaryDTO:
+    id: int
+    name: str
+    is_prediction: bool
+    data_files_count: int
+    rscript_files_count: int
+    total_bytes: int
+    last_upload_time: Optional[datetime]
+    coverage_start: Optional[datetime]
+    coverage_end: Optional[datetime]
+    data_version: int
 
-
+@dataclass
+class PartitionDTO:
+    dataset: str
+    month: str  # YYYY-MM
+    rows_count: int
+    size_bytes: int
+    coverage_start: Optional[datetime]
+    coverage_end: Optional[datetime]
+    data_version: int  # version of the last change
+    dirty: bool  # changed since downstream consumers last marked it clean